@@ -0,0 +1,213 @@
+"""对 DatabaseHandler 的各个方法计时, 输出 p50/p99
+
+python benchmarks/bench_dateset.py bench.db --json results/HEAD.json
+python benchmarks/bench_dateset.py bench.db --compare results/HEAD.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from common import git_revision, load_module, print_header, print_row, summarize
+from generate import WORDS
+
+
+def sample_inputs(path: Path, rng: random.Random, count: int):
+    # 直接用 sqlite3 读出样本, 不计入计时
+    conn = sqlite3.connect(path)
+    groups = [
+        g for g, in conn.execute(
+            "SELECT group_id FROM essence_data GROUP BY group_id ORDER BY COUNT(*) DESC"
+        )
+    ]
+    max_id = conn.execute("SELECT MAX(id) FROM essence_data").fetchone()[0] or 0
+    rows = []
+    for _ in range(count):
+        row = conn.execute(
+            "SELECT time, group_id, sender_id, operator_id, message_type, message_data "
+            "FROM essence_data WHERE id >= ? LIMIT 1",
+            (rng.randint(1, max_id),),
+        ).fetchone()
+        if row is not None:
+            rows.append(row)
+    senders = conn.execute(
+        "SELECT group_id, sender_id FROM essence_data WHERE id >= ? LIMIT 200",
+        (rng.randint(1, max_id),),
+    ).fetchall()
+    conn.close()
+    return groups, rows, senders
+
+
+def build_cases(db, groups, rows, senders, rng):
+    largest = groups[0]
+    today = date.today()
+
+    def pick_group():
+        return rng.choice(groups)
+
+    def exists_data():
+        row = list(rng.choice(rows))
+        if rng.random() < 0.5:
+            row[5] += " (miss)"  # 内容不同, 一定查不到
+        return row
+
+    def summary_date():
+        return (today - timedelta(days=rng.randrange(365))).isoformat()
+
+    def keyword():
+        return " ".join(rng.sample(WORDS, rng.randint(1, 2)))
+
+    def sender_keyword():
+        group_id, sender_id = rng.choice(senders)
+        return group_id, rng.choice(WORDS), sender_id
+
+    # 名称 -> (调用, 默认迭代次数)
+    return {
+        "random_essence": (lambda: db.random_essence(pick_group()), 500),
+        "random_essence[largest]": (lambda: db.random_essence(largest), 500),
+        "random_essence[image]": (lambda: db.random_essence(pick_group(), "image"), 300),
+        "random_essence[at]": (lambda: db.random_essence(largest, "at"), 300),
+        "search_entries": (lambda: db.search_entries(pick_group(), keyword()), 200),
+        "search_entries[largest]": (lambda: db.search_entries(largest, keyword()), 200),
+        "search_entries[sender]": (lambda: db.search_entries(*sender_keyword()), 200),
+        "search_entries[page 5]": (
+            lambda: db.search_entries(largest, rng.choice(WORDS), offset=20),
+            200,
+        ),
+        "sender_segments": (lambda: db.sender_segments(*rng.choice(senders)), 500),
+        "sender_rank": (lambda: db.sender_rank(pick_group()), 500),
+        "sender_rank[30d]": (
+            lambda: db.sender_rank(pick_group(), today - timedelta(days=30)),
+            200,
+        ),
+        "operator_rank": (lambda: db.operator_rank(pick_group()), 500),
+        "summary_by_date": (lambda: db.summary_by_date(summary_date(), pick_group()), 300),
+        "check_entry_exists": (lambda: db.check_entry_exists(exists_data()), 500),
+        "get_latest_nickname": (
+            lambda: db.get_latest_nickname(*rng.choice(senders)),
+            500,
+        ),
+        "delete_matching_entry": (lambda: db.delete_matching_entry(pick_group()), 100),
+        "export_group_data[db]": (lambda: export(db, largest, "db"), 5),
+        "export_group_data[jsonl]": (lambda: export(db, largest, "jsonl"), 5),
+    }
+
+
+async def export(db, group_id, fmt):
+    path = await db.export_group_data(group_id, fmt)
+    os.remove(path)
+
+
+async def run_case(call, iterations: int, warmup: int):
+    for _ in range(warmup):
+        await call()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+async def run(args):
+    dateset = load_module("dateset")
+    imgstore = load_module("imgstore")
+    rng = random.Random(args.seed)
+    groups, rows, senders = sample_inputs(args.path, rng, 1000)
+    if not rows:
+        raise SystemExit(f"{args.path} 里没有数据, 先运行 generate.py")
+
+    # delete_matching_entry 会改数据, 在副本上跑
+    workdir = Path(tempfile.mkdtemp(prefix="essence-bench-"))
+    try:
+        db_copy = workdir / "essence.db"
+        src = sqlite3.connect(args.path)
+        dst = sqlite3.connect(db_copy)
+        src.backup(dst)
+        src.close()
+        dst.close()
+        store = imgstore.ImageStore(args.path.parent / "img" / "sha256")
+        db = dateset.DatabaseHandler(str(db_copy), args.pool, store)
+        await db.open()
+        try:
+            cases = build_cases(db, groups, rows, senders, rng)
+            results = {}
+            for name, (call, iterations) in cases.items():
+                if args.only and not any(o in name for o in args.only):
+                    continue
+                iterations = max(1, int(iterations * args.scale))
+                samples = await run_case(call, iterations, min(args.warmup, iterations))
+                results[name] = summarize(samples)
+                print_row(name, results[name], args.baseline.get(name))
+        finally:
+            await db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def metadata(path: Path):
+    conn = sqlite3.connect(path)
+    rows, groups = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT group_id) FROM essence_data"
+    ).fetchone()
+    conn.close()
+    return {
+        "revision": git_revision(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "rows": rows,
+        "groups": groups,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pool", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="迭代次数倍率")
+    parser.add_argument("--only", nargs="*", help="只跑名字里包含这些字符串的用例")
+    parser.add_argument("--json", type=Path, help="把结果写入 JSON, 供之后 --compare")
+    parser.add_argument("--compare", type=Path, help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    meta = metadata(args.path)
+    args.baseline = {}
+    if args.compare is not None:
+        previous = json.loads(args.compare.read_text(encoding="utf-8"))
+        args.baseline = previous["results"]
+        old = previous["meta"]
+        print(f"baseline: {old['revision']} ({old['rows']} rows, {old['date']})")
+        if old["rows"] != meta["rows"]:
+            print("警告: 数据量不同, 结果不可直接比较")
+    print(
+        f"revision {meta['revision']}, {meta['rows']} rows in {meta['groups']} groups, "
+        f"sqlite {meta['sqlite']}, python {meta['python']}"
+    )
+    print_header(bool(args.baseline))
+    results = asyncio.run(run(args))
+    if args.json is not None:
+        args.json.parent.mkdir(parents=True, exist_ok=True)
+        args.json.write_text(
+            json.dumps({"meta": meta, "results": results}, indent=2), encoding="utf-8"
+        )
+
+
+if __name__ == "__main__":
+    main()
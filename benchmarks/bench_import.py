@@ -0,0 +1,104 @@
+"""测量插件的导入耗时, 每次在新的解释器里加载
+
+python benchmarks/bench_import.py --runs 20 --json results/import.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from common import PACKAGE, ROOT, git_revision, print_header, print_row, summarize
+
+# 先初始化 nonebot 和依赖插件, 只计 load_plugin 本身
+SCRIPT = f"""
+import time
+import nonebot
+from nonebot.adapters.onebot.v11 import Adapter
+nonebot.init()
+nonebot.get_driver().register_adapter(Adapter)
+nonebot.load_plugin("nonebot_plugin_alconna")
+nonebot.load_plugin("nonebot_plugin_localstore")
+started = time.perf_counter()
+nonebot.load_plugin("{PACKAGE}")
+print("LOAD", time.perf_counter() - started)
+"""
+
+
+def run_once(env):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr[-2000:])
+    # -X importtime 输出到 stderr: "import time: self | cumulative | name"
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        name = name.strip()
+        if name.startswith(PACKAGE) and cumulative.strip().isdigit():
+            modules[name] = int(cumulative) / 1000
+    load = next(
+        float(line.split()[1]) * 1000
+        for line in result.stdout.splitlines()
+        if line.startswith("LOAD ")
+    )
+    return load, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--json", type=Path, help="把结果写入 JSON, 供之后 --compare")
+    parser.add_argument("--compare", type=Path, help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(ROOT), env.get("PYTHONPATH")]))
+    env.setdefault("LOG_LEVEL", "WARNING")
+
+    baseline = {}
+    if args.compare is not None:
+        previous = json.loads(args.compare.read_text(encoding="utf-8"))
+        baseline = previous["results"]
+        print(f"baseline: {previous['meta']['revision']} ({previous['meta']['date']})")
+
+    samples = {"load_plugin": []}
+    for _ in range(args.runs):
+        load, modules = run_once(env)
+        samples["load_plugin"].append(load)
+        for name, ms in modules.items():
+            samples.setdefault(name, []).append(ms)
+
+    meta = {
+        "revision": git_revision(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+    }
+    print(f"revision {meta['revision']}, python {meta['python']}, {args.runs} runs")
+    print_header(bool(baseline))
+    results = {}
+    for name, values in sorted(samples.items(), key=lambda item: -max(item[1])):
+        results[name] = summarize(values)
+        print_row(name.replace(PACKAGE, "~"), results[name], baseline.get(name))
+    if args.json is not None:
+        args.json.parent.mkdir(parents=True, exist_ok=True)
+        args.json.write_text(
+            json.dumps({"meta": meta, "results": results}, indent=2), encoding="utf-8"
+        )
+
+
+if __name__ == "__main__":
+    main()
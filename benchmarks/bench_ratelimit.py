@@ -0,0 +1,95 @@
+"""用大量不同的会话压测 essence random 的限流器, 观察内存和单次耗时
+
+python benchmarks/bench_ratelimit.py --sessions 5000000
+"""
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from common import load_module
+
+
+class LegacyLimiter:
+    # 旧版 Helper.reach_limit 的做法: 每个会话一项, 从不删除
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.count = {}
+        self.since = {}
+
+    def __len__(self):
+        return len(self.count)
+
+    def reach(self, session_id: str) -> bool:
+        if session_id not in self.count:
+            self.count[session_id] = 0
+            self.since[session_id] = 0
+        self.count[session_id] += 1
+        if int(time.time()) - self.since[session_id] > 43200:
+            self.count[session_id] = 1
+            self.since[session_id] = int(time.time())
+        return self.count[session_id] > self.limit
+
+
+def run(name, check, size, sessions, step, rng, hot):
+    tracemalloc.start()
+    started = time.perf_counter()
+    print(f"{name}:")
+    print(f"{'sessions':>12} {'entries':>10} {'memory MiB':>11} {'ns/check':>9}")
+    for done in range(step, sessions + step, step):
+        batch_started = time.perf_counter()
+        for i in range(done - step, done):
+            # 10% 的请求来自少量活跃会话, 其余都是新会话
+            key = f"{rng.randrange(hot)}_h" if rng.random() < 0.1 else f"{i}_{i * 7919}"
+            check(key)
+        elapsed = time.perf_counter() - batch_started
+        current, _ = tracemalloc.get_traced_memory()
+        print(
+            f"{done:>12} {size():>10} {current / 2**20:>11.1f} "
+            f"{elapsed / step * 1e9:>9.0f}"
+        )
+    tracemalloc.stop()
+    print(f"total {time.perf_counter() - started:.1f}s\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=2_000_000)
+    parser.add_argument("--step", type=int, default=500_000)
+    parser.add_argument("--max-keys", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--hot", type=int, default=1000, help="活跃会话数")
+    parser.add_argument("--legacy", action="store_true", help="同时跑旧版实现作对比")
+    args = parser.parse_args()
+
+    ratelimit = load_module("ratelimit")
+    limiter = ratelimit.RateLimiter(args.limit, 43200, args.max_keys)
+    run(
+        f"RateLimiter(max_keys={args.max_keys})",
+        limiter.hit,
+        limiter.__len__,
+        args.sessions,
+        args.step,
+        random.Random(0),
+        args.hot,
+    )
+    if args.legacy:
+        legacy = LegacyLimiter(args.limit)
+        run(
+            "legacy reach_limit",
+            legacy.reach,
+            legacy.__len__,
+            args.sessions,
+            args.step,
+            random.Random(0),
+            args.hot,
+        )
+
+
+if __name__ == "__main__":
+    main()
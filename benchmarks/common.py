@@ -0,0 +1,69 @@
+import importlib
+import subprocess
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+PACKAGE = "nonebot_plugin_essence_message"
+
+
+def load_module(name: str):
+    # 只加载需要的子模块, 跳过插件 __init__ 里依赖 nonebot 运行环境的部分
+    if PACKAGE not in sys.modules:
+        pkg = types.ModuleType(PACKAGE)
+        pkg.__path__ = [str(ROOT / PACKAGE)]
+        sys.modules[PACKAGE] = pkg
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+def percentile(samples, p: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(samples):
+    return {
+        "n": len(samples),
+        "p50": percentile(samples, 50),
+        "p99": percentile(samples, 99),
+        "mean": sum(samples) / len(samples),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_header(compare: bool):
+    columns = f"{'case':<28}{'n':>6}{'p50 ms':>11}{'p99 ms':>11}{'mean ms':>11}"
+    if compare:
+        columns += f"{'p50 Δ':>10}{'p99 Δ':>10}"
+    print(columns)
+    print("-" * len(columns))
+
+
+def print_row(name, result, baseline=None):
+    line = (
+        f"{name:<28}{result['n']:>6}{result['p50']:>11.3f}"
+        f"{result['p99']:>11.3f}{result['mean']:>11.3f}"
+    )
+    if baseline is not None:
+        for key in ("p50", "p99"):
+            change = (result[key] / baseline[key] - 1) * 100 if baseline[key] else 0
+            line += f"{change:>+9.1f}%"
+    print(line, flush=True)
@@ -0,0 +1,187 @@
+"""生成用于基准测试的合成精华数据库
+
+python benchmarks/generate.py bench.db --rows 100000 --groups 50
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from common import load_module
+
+WORDS = (
+    "今天 明天 群主 管理 精华 复读 好耶 草 笑死 绷不住 原神 启动 摸鱼 下班 "
+    "加班 周末 睡觉 吃饭 火锅 奶茶 猫猫 狗狗 游戏 上分 开黑 抽卡 保底 歪了 "
+    "hello world python nonebot sqlite bug fix deploy release meme lol"
+).split()
+DAY = 86400
+
+
+def zipf_weights(n: int, s: float = 1.1):
+    return [1 / (i + 1) ** s for i in range(n)]
+
+
+def text_message(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 24)))
+
+
+def image_pool(store, size: int, rng: random.Random):
+    # 图片会被反复转发, 用一个小池子模拟 sha256 去重后的引用
+    refs = []
+    for i in range(size):
+        data = rng.randbytes(256) + i.to_bytes(4, "big")
+        refs.append(store._put(data))
+    return refs
+
+
+def group_message(rng: random.Random, refs) -> str:
+    parts = []
+    for _ in range(rng.randint(2, 5)):
+        kind = rng.random()
+        if kind < 0.6:
+            parts.append(["text", text_message(rng)])
+        elif kind < 0.85:
+            parts.append(["image", rng.choice(refs)])
+        else:
+            parts.append(["at", str(rng.randint(10000, 99999999))])
+    return json.dumps(parts, ensure_ascii=False)
+
+
+def rows_for_group(rng, group_id, count, members, refs, now, span_days):
+    weights = zipf_weights(len(members))
+    operators = members[: max(1, len(members) // 20)]
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.7:
+            message_type, data = "text", text_message(rng)
+        elif kind < 0.9:
+            message_type, data = "image", rng.choice(refs)
+        else:
+            message_type, data = "group", group_message(rng, refs)
+        yield (
+            now - rng.randrange(span_days * DAY),
+            group_id,
+            rng.choices(members, weights)[0],
+            rng.choice(operators),
+            message_type,
+            data,
+        )
+
+
+async def init_schema(path: Path, store):
+    dateset = load_module("dateset")
+    db = dateset.DatabaseHandler(str(path), 1, store)
+    await db.open()
+    await db.close()
+
+
+def generate(path: Path, rows: int, groups: int, seed: int, span_days: int, batch: int):
+    rng = random.Random(seed)
+    dateset = load_module("dateset")
+    imgstore = load_module("imgstore")
+    segments = load_module("segments")
+    migrations = load_module("migrations")
+    store = imgstore.ImageStore(path.parent / "img" / "sha256")
+    asyncio.run(init_schema(path, store))
+    refs = image_pool(store, 64, rng)
+    now = int(time.time())
+
+    # 群大小也服从长尾分布: 少数活跃群占大部分精华
+    weights = zipf_weights(groups, 0.9)
+    total = sum(weights)
+    sizes = [max(1, int(rows * w / total)) for w in weights]
+    sizes[0] += rows - sum(sizes)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = WAL")
+    insert = (
+        f"INSERT OR IGNORE INTO essence_data ({dateset.INSERT_COLUMNS}) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    insert_del = insert.replace("OR IGNORE INTO essence_data", "INTO del_essence_data", 1)
+    message_ids = iter(range(1, 2**31))
+    done = 0
+    started = time.perf_counter()
+    for index, size in enumerate(sizes):
+        group_id = 100000 + index
+        members = rng.sample(range(10000, 99999999), max(5, min(2000, size // 10)))
+        pending = []
+        for row in rows_for_group(rng, group_id, size, members, refs, now, span_days):
+            pending.append(dateset.insert_row((*row, next(message_ids))))
+            if len(pending) >= batch:
+                done += _flush(conn, insert, insert_del, pending, rng)
+        done += _flush(conn, insert, insert_del, pending, rng)
+
+        # 昵称变动: 每个成员按长尾分布改名若干次, 表里只保留最新的
+        churn = []
+        for user_id in members:
+            for change in range(1 + int(rng.expovariate(1.0) * 2)):
+                nickname = f"{rng.choice(WORDS)}{user_id % 1000}_{change}"
+                churn.append((nickname, group_id, user_id, now - rng.randrange(span_days * DAY)))
+        churn.sort(key=lambda r: r[3])
+        conn.execute("BEGIN")
+        conn.executemany(
+            """INSERT INTO user_mapping (nickname, group_id, user_id, time) VALUES (?, ?, ?, ?)
+               ON CONFLICT (group_id, user_id) DO UPDATE
+               SET nickname = excluded.nickname, time = excluded.time""",
+            churn,
+        )
+        conn.execute("COMMIT")
+        print(f"\r{done}/{rows} rows, {index + 1}/{groups} groups", end="", flush=True)
+    # 多段消息的分段由插件写入时解析, 这里一次补齐
+    conn.execute("BEGIN")
+    conn.executemany(
+        migrations.SEGMENT_INSERT,
+        [
+            seg
+            for row in conn.execute(
+                "SELECT id, group_id, sender_id, message_data FROM essence_data "
+                "WHERE message_type = 'group'"
+            ).fetchall()
+            for seg in segments.segment_rows(*row)
+        ],
+    )
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA optimize")
+    conn.close()
+    print(f"\ngenerated {done} rows in {time.perf_counter() - started:.1f}s -> {path}")
+
+
+def _flush(conn, insert, insert_del, pending, rng):
+    if not pending:
+        return 0
+    conn.execute("BEGIN")
+    conn.executemany(insert, pending)
+    # 约 1% 的精华被取消, 留给 delete_matching_entry 使用
+    conn.executemany(insert_del, [row for row in pending if rng.random() < 0.01])
+    conn.execute("COMMIT")
+    count = len(pending)
+    pending.clear()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--days", type=int, default=3 * 365)
+    parser.add_argument("--batch", type=int, default=10_000)
+    args = parser.parse_args()
+    if args.path.exists():
+        parser.error(f"{args.path} 已存在")
+    args.path.parent.mkdir(parents=True, exist_ok=True)
+    generate(args.path, args.rows, args.groups, args.seed, args.days, args.batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,180 @@
-import httpx
 import asyncio
-import base64
+import json
 import time
 import os
-import json
+from datetime import date, datetime, timedelta
 
 from .dateset import DatabaseHandler
+from .download import DownloadError, Downloader
+from .essences import EssenceListCache
+from .formatter import MessageFormatter
+from .imgstore import ImageStore
+from .jobs import JobRunner
+from .metrics import API_SECONDS, metrics
+from .names import NicknameCache
+from .ratelimit import RateLimiter
+from .reaction import ReactionCounter
+from .segments import parse_segments
+from .shards import ShardedDatabase, merge_shards
 from .config import config
 
-from nonebot import get_plugin_config
+from nonebot import get_bots, get_driver, get_plugin_config, logger
+from nonebot.adapters import Bot as BaseBot
 from nonebot.adapters.onebot.v11.bot import Bot
-from nonebot.adapters.onebot.v11 import GroupMessageEvent
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, Message, MessageSegment
 
 
-db = DatabaseHandler(config.db())
-asyncio.run(db._create_table())
 cfg = get_plugin_config(config)
+img_store = ImageStore(config.img() / "sha256")
+if cfg.essence_db_sharding:
+    db = ShardedDatabase(
+        config.db(),
+        config.shards(),
+        cfg.essence_db_max_open_shards,
+        cfg.essence_db_pool_size,
+        cfg.essence_db_shard_pool_size,
+        img_store,
+        cfg.essence_write_batch_size,
+        cfg.essence_write_delay,
+        cfg.essence_compress,
+        cfg.essence_compress_min_bytes,
+    )
+else:
+    db = DatabaseHandler(
+        config.db(),
+        cfg.essence_db_pool_size,
+        img_store,
+        cfg.essence_write_batch_size,
+        cfg.essence_write_delay,
+        cfg.essence_compress,
+        cfg.essence_compress_min_bytes,
+    )
+good_counter = ReactionCounter(db, cfg.essence_good_ttl)
+name_cache = NicknameCache(db, cfg.essence_name_cache_size, cfg.essence_name_ttl)
+essence_lists = EssenceListCache(cfg.essence_list_ttl, max_groups=cfg.essence_list_cache_size)
+user_limiter = RateLimiter(
+    cfg.essence_random_limit, cfg.essence_random_period, cfg.essence_random_max_sessions
+)
+group_limiter = (
+    RateLimiter(
+        cfg.essence_random_group_limit,
+        cfg.essence_random_period,
+        cfg.essence_random_max_sessions,
+    )
+    if cfg.essence_random_group_limit > 0
+    else None
+)
+# 开启 essence_random_persist 时关闭前保存剩余次数, 重启后接着算
+random_limits = [(user_limiter, config.cache() / "random_limit_user.json")]
+if group_limiter is not None:
+    random_limits.append((group_limiter, config.cache() / "random_limit_group.json"))
+downloader = Downloader(cfg.essence_download_timeout, cfg.essence_download_max_bytes)
+
+metrics.enabled = cfg.essence_metrics
+metrics_file = config.cache() / "metrics.prom"
+_metrics_task = None
+_digest_task = None
+_api_started = {}
+
+driver = get_driver()
+
+
+async def _export_metrics():
+    while True:
+        await asyncio.sleep(cfg.essence_metrics_interval)
+        await asyncio.to_thread(metrics.write_prometheus, metrics_file)
+
+
+async def _post_digests(hour: int, minute: int):
+    # 每天定时把当天的精华日报发到启用的群
+    while True:
+        now = datetime.now()
+        run_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if run_at <= now:
+            run_at += timedelta(days=1)
+        await asyncio.sleep((run_at - now).total_seconds())
+        today = date.today()
+        # 同一个群有多个 bot 时只由第一个在群里的 bot 发送
+        group_bots = {}
+        for bot in get_bots().values():
+            if not isinstance(bot, Bot):
+                continue
+            try:
+                for group in await bot.get_group_list():
+                    group_bots.setdefault(group["group_id"], bot)
+            except Exception as e:
+                logger.warning(f"获取 {bot.self_id} 的群列表失败: {e!r}")
+        for group_id, bot in group_bots.items():
+            if "all" not in cfg.essence_enable_groups and group_id not in cfg.essence_enable_groups:
+                continue
+            try:
+                text = await render_digest(
+                    bot, group_id, today, today + timedelta(days=1), f"{today} "
+                )
+                if text is not None:
+                    await bot.send_group_msg(group_id=group_id, message=text)
+            except Exception as e:
+                logger.warning(f"群 {group_id} 的精华日报发送失败: {e!r}")
+
+
+@driver.on_startup
+async def _startup():
+    global _metrics_task, _digest_task
+    await db.open()
+    if not cfg.essence_db_sharding:
+        # 关闭分库后, 之前拆出去的精华并回主库
+        await merge_shards(db, config.shards())
+    await good_counter.load(config.cache() / "good_cache.json")
+    if cfg.essence_random_persist:
+        for limiter, path in random_limits:
+            limiter.load(path)
+    if metrics.enabled and cfg.essence_metrics_interval > 0:
+        _metrics_task = asyncio.create_task(_export_metrics())
+    if cfg.essence_digest_time:
+        try:
+            hour, minute = map(int, cfg.essence_digest_time.split(":"))
+            datetime.now().replace(hour=hour, minute=minute)
+        except ValueError:
+            logger.warning(f"essence_digest_time 格式应为 HH:MM: {cfg.essence_digest_time}")
+        else:
+            _digest_task = asyncio.create_task(_post_digests(hour, minute))
+
+
+@driver.on_shutdown
+async def _shutdown():
+    if _digest_task is not None:
+        _digest_task.cancel()
+    if _metrics_task is not None:
+        _metrics_task.cancel()
+        await asyncio.to_thread(metrics.write_prometheus, metrics_file)
+    await jobs.close()
+    await save_manifest()
+    await good_counter.close()
+    if cfg.essence_random_persist:
+        for limiter, path in random_limits:
+            limiter.save(path)
+    await downloader.close()
+    await db.close()
+
+
+@driver.on_bot_connect
+async def _resume_jobs(bot: BaseBot):
+    if isinstance(bot, Bot):
+        await jobs.resume(bot)
+
+
+@BaseBot.on_calling_api
+async def _calling_api(bot: BaseBot, api: str, data: dict):
+    if metrics.enabled:
+        # 两个钩子拿到的是同一个 data 对象
+        _api_started[id(data)] = time.perf_counter()
+
+
+@BaseBot.on_called_api
+async def _called_api(bot: BaseBot, exception, api: str, data: dict, result):
+    started = _api_started.pop(id(data), None)
+    if started is not None:
+        API_SECONDS.observe(api, time.perf_counter() - started, exception is not None)
 
 
 def trigger_rule(event: GroupMessageEvent) -> bool:
@@ -23,169 +182,234 @@ def trigger_rule(event: GroupMessageEvent) -> bool:
         "all" in cfg.essence_enable_groups
     )
 
-good_cache = config.cache() / 'good_cache.json'
-if good_cache.exists():  
-    with good_cache.open('r', encoding='utf-8') as f:  
-        __good_count = json.load(f)  
-else:
-    __good_count = {}
 
 def good_essence(message_id: str) -> int:
-    global __good_count
-    with open(good_cache, 'w', encoding='utf-8') as f:  
-        json.dump(__good_count, f, ensure_ascii=False, indent=4)  
-    return __good_count[message_id] >= cfg.good_bound
+    return good_counter.get(message_id) >= cfg.good_bound
 
 def add_good_count(message_id: str) -> int:
-    global __good_count
-    if message_id in __good_count:
-        __good_count[message_id] += 1
-    else:
-        __good_count[message_id] = 1
-    return __good_count[message_id]
+    return good_counter.add(message_id)
 
 def del_good_count(message_id: str) -> int:
-    global __good_count
-    if message_id in __good_count:
-        __good_count[message_id] -= 1
-    else:
-        __good_count[message_id] = 0
-    if __good_count[message_id] < 0:
-        __good_count[message_id] = 0
-    return __good_count[message_id]
+    return good_counter.remove(message_id)
 
 async def get_name(bot: Bot, group_id: int, id: int) -> str:
-    ti = time.time()
-    i = await db.get_latest_nickname(group_id, id)
-    if i == None:
-        try:
-            sender = await asyncio.wait_for(
-                bot.get_group_member_info(group_id=group_id, user_id=id), 3
-            )
-            name = (
-                sender["nickname"]
-                if (sender["card"] == None or sender["card"] == "")
-                else sender["card"]
-            )
-            await db.insert_user_mapping(
-                name, sender["group_id"], sender["user_id"], int(ti)
-            )
-            return name
-        except:
-            return "<unknown>"
-    else:
-        if ti % 10 <= 1:
-            try:
-                sender = await asyncio.wait_for(
-                    bot.get_group_member_info(
-                        group_id=group_id, user_id=id, no_cache=True
-                    ),
-                    2,
-                )
-                name = (
-                    sender["nickname"]
-                    if (sender["card"] == None or sender["card"] == "")
-                    else sender["card"]
-                )
-                await db.insert_user_mapping(
-                    name,
-                    sender["group_id"],
-                    sender["user_id"],
-                    int(ti),
-                )
-                return name
-            except:
-                return i[0]
-        else:
-            return i[0]
+    return await name_cache.get(bot, group_id, id)
 
 
-__time_count = {}
-__random_count = {}
+async def get_essence_message(bot: Bot, group_id: int, message_id: int):
+    # get_msg 拿不到时(消息过期等)退回到群精华列表里找, 返回 (消息, 发送者)
+    try:
+        msg = await bot.get_msg(message_id=message_id)
+        return msg, msg["sender"]["user_id"]
+    except Exception:
+        essence = await essence_lists.find(bot, group_id, message_id)
+        if essence is None:
+            return None, None
+        return {"message": essence["content"]}, essence["sender_id"]
 
-def reach_limit(session_id: str) -> bool:
-    global __random_count, __time_count
-    if session_id not in __random_count:
-        __random_count[session_id] = 0
-        __time_count[session_id] = 0
 
-    __random_count[session_id] += 1
-    if int(time.time()) - __time_count[session_id] > 43200:
-        __random_count[session_id] = 1
-        __time_count[session_id] = int(time.time())
+async def render_digest(bot: Bot, group_id: int, start: date, end: date, title: str):
+    digest = await db.digest(group_id, start, end)
+    if digest["total"] == 0:
+        return None
+    counts = digest["counts"]
+    other = digest["total"] - counts.get("text", 0) - counts.get("image", 0)
+    lines = [
+        f"{title}精华摘要",
+        f"共 {digest['total']} 条精华: 文字 {counts.get('text', 0)}, "
+        f"图片 {counts.get('image', 0)}, 其他 {other}",
+    ]
+    for role, label in (("senders", "被设精最多"), ("operators", "设精最多")):
+        names = await asyncio.gather(
+            *[get_name(bot, group_id, user_id) for user_id, _ in digest[role]]
+        )
+        ranked = ", ".join(
+            f"{name}({count})" for name, (_, count) in zip(names, digest[role])
+        )
+        lines.append(f"{label}: {ranked}")
+    for _, _, sender_id, _, _, data in digest["samples"]:
+        if len(data) > 50:
+            data = data[:50] + "..."
+        lines.append(f"> {await get_name(bot, group_id, sender_id)}: {data}")
+    return "\n".join(lines)
 
-    # 判断是否超出限制
-    if __random_count[session_id] > cfg.essence_random_limit:
-        return True
-    elif __random_count[session_id] == 1:
-        __time_count[session_id] = int(time.time())
 
+async def image_segment(ref: str):
+    # 图片文件可能被清理过, 或由 jsonl 导入时没带图片, 找不到时用文字代替
+    try:
+        return MessageSegment.image(file=await img_store.load(ref))
+    except FileNotFoundError:
+        logger.warning(f"精华图片文件缺失: {ref}")
+        return MessageSegment.text("[图片]")
+
+
+async def render_segments(bot: Bot, group_id: int, sender_id: int, message_type: str, data: str):
+    # 把多段精华还原成可发送的消息, 无法还原的段显示为 [类型]
+    message = Message(MessageSegment.text(f"{await get_name(bot, group_id, sender_id)}:"))
+    for kind, value in parse_segments(message_type, data):
+        if kind == "text":
+            message += MessageSegment.text(value)
+        elif kind == "image":
+            message += await image_segment(value)
+        elif kind == "at" and value.isdigit():
+            message += MessageSegment.at(int(value))
+        elif kind == "face" and value.isdigit():
+            message += MessageSegment.face(int(value))
+        else:
+            message += MessageSegment.text(f"[{kind}]")
+    return message
+
+
+def reach_limit(group_id: int, user_id: int) -> bool:
+    # 用户和群的次数都够时才同时扣除
+    limits = [(user_limiter, f"{group_id}_{user_id}")]
+    if group_limiter is not None:
+        limits.append((group_limiter, group_id))
+    if any(limiter.remaining(key) < 1 for limiter, key in limits):
+        return True
+    for limiter, key in limits:
+        limiter.hit(key)
     return False
 
 
+async def download_image(url: str) -> str:
+    tmp, digest = await downloader.fetch(url, img_store.tmp_dir)
+    return await img_store.adopt(tmp, digest)
+
+
+formatter = MessageFormatter(
+    download_image, cfg.essence_reply_depth, cfg.essence_reply_cache_size
+)
+
+
 async def format_msg(msg, bot: Bot):
-    result = []
-    for msg_part in msg["message"]:
-        if msg_part["type"] == "text":
-            re = [msg_part["type"], msg_part["data"]["text"]]
-        elif msg_part["type"] == "image":
-            async with httpx.AsyncClient() as client:
-                r = await client.get(msg_part["data"]["url"])
-            if r.status_code == 200:
-                base64str = base64.b64encode(r.content).decode("utf-8")
-                re = [msg_part["type"], f"base64://{base64str}"]
-            else:
-                return None
-        elif msg_part["type"] == "at":
-            re = [msg_part["type"], msg_part["data"]["qq"]]
-        elif msg_part["type"] == "reply":
-            try:
-                remsg = await bot.get_msg(message_id=msg_part["data"]["id"])
-                remsg = await format_msg(remsg, bot)
-                remsg = f"[{remsg[0]},{remsg[1]}]"
-            except:
-                remsg = "[]"
-            re = [msg_part["type"], remsg]
-            pass
-        result.append(re)
-    if len(result) == 1:
-        result = result[0]
-    else:
-        remsg = ""
-        for re in result:
-            remsg = remsg + f"[{re[0]},{re[1]}],"
-        result = ["group", remsg]
-    return result
-
-
-async def fetchpic(essencelist):
+    return await formatter.format(msg, bot)
+
+
+async def ingest_essence(bot: Bot, group_id: int, essence):
+    # 只整理成一行数据, 由 insert_essences 按批写入
+    msg = await format_msg({"message": essence["content"]}, bot)
+    if msg is None:
+        raise DownloadError("精华中的图片下载失败")
+    return [
+        essence["operator_time"],
+        group_id,
+        essence["sender_id"],
+        essence["operator_id"],
+        msg[0],
+        msg[1],
+        essence.get("message_id"),
+    ]
+
+
+async def insert_essences(bot: Bot, group_id: int, datas):
+    return await db.insert_many(datas)
+
+
+async def delete_essence(bot: Bot, group_id: int, message_id):
+    await bot.delete_essence_msg(message_id=message_id)
+
+
+async def _cleaned(bot: Bot, group_id: int):
+    essence_lists.invalidate(group_id)
+
+
+UNSAFE_FILENAME = str.maketrans({c: "_" for c in '\\/:*?"<>|'})
+
+
+def _load_manifest(path):
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    return {"done": {}, "hashes": {}}
+
+
+def _save_manifest(path, manifest):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _files_exist(directory, filenames):
+    return all((directory / filename).exists() for filename in filenames)
+
+
+_manifest_loading = None
+# sha256 -> 正在保存这张图片的 future
+_saving_images = {}
+
+
+async def _image_manifest():
+    # manifest 记录已完成的精华及其图片文件名、已保存图片的哈希, 进程内只加载一次
+    global _manifest_loading
+    if _manifest_loading is None:
+        _manifest_loading = asyncio.ensure_future(
+            asyncio.to_thread(_load_manifest, config.img() / "manifest.json")
+        )
+    manifest = await asyncio.shield(_manifest_loading)
+    if isinstance(manifest["done"], list):
+        # 旧格式只记了精华, 没记文件名, 无法确认图片还在, 重新检查一遍
+        manifest["done"] = {}
+    return manifest
+
+
+async def save_manifest(bot: Bot = None, group_id: int = None):
+    if _manifest_loading is None or not _manifest_loading.done():
+        return
+    manifest = _manifest_loading.result()
+    await asyncio.to_thread(
+        _save_manifest,
+        config.img() / "manifest.json",
+        {"done": dict(manifest["done"]), "hashes": dict(manifest["hashes"])},
+    )
+
+
+async def _store_image(directory, hashes, tmp, digest, filename) -> str:
+    # 同一张图片同时只保存一次; 记录过但文件已被删掉的图片重新保存
+    while digest in _saving_images:
+        await asyncio.shield(_saving_images[digest])
+    saved = hashes.get(digest)
+    if saved is not None and await asyncio.to_thread(_files_exist, directory, [saved]):
+        await asyncio.to_thread(os.unlink, tmp)
+        return saved
+    saving = asyncio.get_running_loop().create_future()
+    _saving_images[digest] = saving
+    try:
+        await asyncio.to_thread(os.replace, tmp, directory / filename)
+        hashes[digest] = filename
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        del _saving_images[digest]
+        saving.set_result(None)
+    return filename
+
+
+async def save_images(bot: Bot, group_id: int, essence):
+    # 保存一条精华里的图片, 下载失败时抛出 DownloadError, 由任务重试
     image_directory = config.img()
     os.makedirs(image_directory, exist_ok=True)
-    savecount = 0
-
-    async with httpx.AsyncClient() as client:
-        for essence in essencelist:
-            sender_time = essence["operator_time"]
-            sender_nick = essence["sender_nick"]
-            for content in essence["content"]:
-                if content["type"] == "image":
-                    image_url = content["data"]["url"]
-                    response = await client.get(image_url)
-                    if response.status_code == 200:
-                        image_data = response.content
-                        image_filename = f"{sender_time}_{sender_nick}.jpeg"
-                        image_path_count = 1
-                        image_save_path = os.path.join(image_directory, image_filename)
-                        while os.path.exists(image_save_path):
-                            image_filename = (
-                                f"{sender_time}_{sender_nick}({image_path_count}).jpeg"
-                            )
-                            image_save_path = os.path.join(
-                                image_directory, image_filename
-                            )
-                            image_path_count += 1
-                        with open(image_save_path, "wb") as image_file:
-                            image_file.write(image_data)
-                            savecount += 1
-
-    return savecount
+    manifest = await _image_manifest()
+    done, hashes = manifest["done"], manifest["hashes"]
+    key = f"{group_id}_{essence['message_id']}"
+    if key in done and await asyncio.to_thread(_files_exist, image_directory, done[key]):
+        return
+    sender_nick = str(essence["sender_nick"]).translate(UNSAFE_FILENAME)
+    files = []
+    for content in essence["content"]:
+        if content["type"] != "image":
+            continue
+        tmp, digest = await downloader.fetch(content["data"]["url"], image_directory)
+        filename = f"{essence['operator_time']}_{sender_nick}_{digest[:8]}.jpeg"
+        files.append(await _store_image(image_directory, hashes, tmp, digest, filename))
+    done[key] = files
+    if len(done) % 20 == 0:
+        await save_manifest()
+
+
+jobs = JobRunner(db, cfg.essence_job_concurrency, cfg.essence_job_retries)
+# 只有 clean 逐条调用 OneBot 接口, 需要限速; 另外两种只下载图片和写库
+jobs.register("clean", "删除群精华", delete_essence, _cleaned, rate=cfg.essence_job_rate)
+jobs.register("fetchall", "抓取精华", ingest_essence, on_batch=insert_essences)
+jobs.register("saveall", "保存精华图片", save_images, save_manifest)
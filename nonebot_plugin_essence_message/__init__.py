@@ -1,4 +1,8 @@
+import os
+import time
 from asyncio import gather
+from datetime import date, timedelta
+from typing import Optional
 
 from nonebot import on_type
 from nonebot.adapters.onebot.v11 import (
@@ -11,13 +15,16 @@ from nonebot.adapters.onebot.v11 import GROUP_ADMIN, GROUP_OWNER
 from nonebot.adapters.onebot.v11.bot import Bot
 from nonebot.plugin import PluginMetadata
 from nonebot import require
+from nonebot.matcher import Matcher
+from nonebot.message import run_postprocessor, run_preprocessor
 
 require("nonebot_plugin_alconna")
-from arclet.alconna import Alconna, Args, Subcommand, Option
-from nonebot_plugin_alconna import AlconnaMatch, Match, Query, on_alconna
+from arclet.alconna import Alconna, Args, Subcommand, Option, MultiVar
+from nonebot_plugin_alconna import ALCONNA_RESULT, AlconnaMatch, Match, Query, on_alconna
 
-from .Helper import fetchpic, format_msg, reach_limit, get_name, trigger_rule, good_essence,add_good_count,del_good_count, db
+from .Helper import format_msg, jobs, reach_limit, get_name, render_digest, render_segments, image_segment, get_essence_message, trigger_rule, good_essence,add_good_count,del_good_count, db, essence_lists
 from .config import config
+from .metrics import HANDLER_SECONDS, metrics
 
 __plugin_meta__ = PluginMetadata(
     name="精华消息管理",
@@ -35,9 +42,15 @@ essence_cmd = on_alconna(
     Alconna(
         "essence",
         Subcommand("help"),
-        Subcommand("random"),
-        Subcommand("search", Args["keyword", str]),
-        Subcommand("rank", Args["type", str]),
+        Subcommand("random", Args["type", str, "all"]),
+        Subcommand(
+            "search",
+            Args["keyword", MultiVar(str, "*")],
+            Option("-s|--sender", Args["sender", int]),
+            Option("-p|--page", Args["page", int]),
+        ),
+        Subcommand("rank", Args["type", str]["period", str, "all"]),
+        Subcommand("digest", Args["period", str, "today"]),
     ),
     rule=trigger_rule,
     priority=5,
@@ -49,9 +62,13 @@ essence_cmd_admin = on_alconna(
         "essence",
         Subcommand("cancel"),
         Subcommand("fetchall"),
-        Subcommand("export"),
+        Subcommand("export", Args["format", str, "db"]),
         Subcommand("saveall"),
         Subcommand("clean"),
+        Subcommand("rebuild"),
+        Subcommand("stats", Args["action", str, "show"]),
+        Subcommand("vacuum"),
+        Subcommand("job", Args["action", str, "status"]),
     ),
     rule=trigger_rule,
     priority=4,
@@ -61,6 +78,32 @@ essence_cmd_admin = on_alconna(
 
 trigood = on_type((NoticeEvent,), priority=11,block=False)
 
+_matcher_names = {essence_set: "essence_set", trigood: "reaction"}
+
+
+def _handler_name(matcher: Matcher):
+    if isinstance(matcher, (essence_cmd, essence_cmd_admin)):
+        result = matcher.state.get(ALCONNA_RESULT)
+        subcommands = list(result.result.subcommands) if result else []
+        return f"essence {subcommands[0]}" if subcommands else "essence"
+    return _matcher_names.get(type(matcher))
+
+
+@run_preprocessor
+async def _start_timer(matcher: Matcher):
+    if metrics.enabled and _handler_name(matcher) is not None:
+        matcher.state["_essence_started"] = time.perf_counter()
+
+
+@run_postprocessor
+async def _stop_timer(matcher: Matcher, exception: Optional[Exception]):
+    started = matcher.state.pop("_essence_started", None)
+    if started is not None:
+        HANDLER_SECONDS.observe(
+            _handler_name(matcher), time.perf_counter() - started, exception is not None
+        )
+
+
 @trigood.handle()
 async def __(event: NoticeEvent, bot: Bot):
     if event.notice_type == 'reaction':
@@ -73,15 +116,9 @@ async def __(event: NoticeEvent, bot: Bot):
             if event.code == '76':
                 del_good_count(f'{event.group_id}_{event.message_id}')
                 if not good_essence(f'{event.group_id}_{event.message_id}'):
-                    try:
-                        msg = await bot.get_msg(message_id=event.message_id)
-                        sender = msg['sender']['user_id']
-                    except:
-                        essencelist = await bot.get_essence_msg_list(group_id=event.group_id)
-                        for essence in essencelist:
-                            if essence["message_id"] == event.message_id:
-                                msg = {"message": essence["content"]}
-                                break
+                    msg, sender = await get_essence_message(bot, event.group_id, event.message_id)
+                    if msg is None:
+                        return
                     msg = await format_msg(msg, bot)
                     if msg == None:
                         essence_set.finish(MessageSegment.text("呜呜"))
@@ -92,23 +129,19 @@ async def __(event: NoticeEvent, bot: Bot):
                         bot.self_id,
                         msg[0],
                         msg[1],
+                        event.message_id,
                     ]
-                    if await db.check_entry_exists(data):
+                    # 只撤销机器人自己设的精华
+                    if await db.check_entry_exists(data, int(bot.self_id)):
                         await bot.delete_essence_msg(message_id=event.message_id)
-                        del_data = await db.delete_matching_entry(event.group_id)
-                        pass
+                        await db.delete_entry(data, int(bot.self_id))
 
 @essence_set.handle()
 async def _(event: NoticeEvent, bot: Bot):
     if event.notice_type == "essence" and event.sub_type == "add":
-        try:
-            msg = await bot.get_msg(message_id=event.message_id)
-        except:
-            essencelist = await bot.get_essence_msg_list(group_id=event.group_id)
-            for essence in essencelist:
-                if essence["message_id"] == event.message_id:
-                    msg = {"message": essence["content"]}
-                    break
+        msg, _ = await get_essence_message(bot, event.group_id, event.message_id)
+        if msg is None:
+            return
         msg = await format_msg(msg, bot)
         if msg == None:
             essence_set.finish(MessageSegment.text("呜呜"))
@@ -119,17 +152,13 @@ async def _(event: NoticeEvent, bot: Bot):
             event.operator_id,
             msg[0],
             msg[1],
+            event.message_id,
         ]
-        await db.insert_data(data)
+        await db.queue_insert(data)
     elif event.notice_type == "essence" and event.sub_type == "delete":
-        try:
-            msg = await bot.get_msg(message_id=event.message_id)
-        except:
-            essencelist = await bot.get_essence_msg_list(group_id=event.group_id)
-            for essence in essencelist:
-                if essence["message_id"] == event.message_id:
-                    msg = {"message": essence["content"]}
-                    break
+        msg, _ = await get_essence_message(bot, event.group_id, event.message_id)
+        if msg is None:
+            return
         msg = await format_msg(msg, bot)
         if msg == None:
             essence_set.finish(MessageSegment.text("呜呜"))
@@ -140,8 +169,9 @@ async def _(event: NoticeEvent, bot: Bot):
             event.operator_id,
             msg[0],
             msg[1],
+            event.message_id,
         ]
-        await db.insert_del_data(data)
+        await db.queue_del_data(data)
         pass
 
 
@@ -150,22 +180,33 @@ async def help_cmd():
     await essence_cmd.finish(
         "使用说明:\n"
         + "essence help - 显示此帮助信息\n"
-        + "essence random - 随机发送一条精华消息\n"
-        + "essence rank sender - 显示发送者精华消息排行榜\n"
-        + "essence rank operator - 显示管理员设精数量精华消息排行榜\n"
+        + "essence random [text|image|at|...] - 随机发送一条(包含指定类型内容的)精华消息\n"
+        + "essence search [关键词...] [-s QQ号] [-p 页码] - 搜索精华消息, 只给 QQ 号时列出他的所有文字\n"
+        + "essence rank sender [week|month|all] - 显示发送者精华消息排行榜\n"
+        + "essence rank operator [week|month|all] - 显示管理员设精数量精华消息排行榜\n"
+        + "essence digest [today|week|month|YYYY-MM-DD] - 精华摘要\n"
         + "essence cancel - 在数据库中删除最近取消的一条精华消息\n"
         + "essence fetchall - 获取群内所有精华消息\n"
-        + "essence export - 导出精华消息\n"
+        + "essence export [db|jsonl|zip] - 导出精华消息\n"
         + "essence saveall - 将群内所有精华消息图片存至本地\n"
-        + "essence clean - 删除群里所有精华消息(数据库中保留)"
+        + "essence clean - 删除群里所有精华消息(数据库中保留)\n"
+        + "essence rebuild - 校验并重建本群排行榜计数\n"
+        + "essence stats [reset] - 查看或清空耗时统计\n"
+        + "essence vacuum - 整理数据库并回收空间(仅超级用户)\n"
+        + "essence job status - 查看本群 fetchall/saveall/clean 任务的进度"
     )
 
 
 @essence_cmd.assign("random")
-async def random_cmd(event: GroupMessageEvent, bot: Bot):
-    if reach_limit(event.get_session_id()):
+async def random_cmd(
+    event: GroupMessageEvent, bot: Bot, type: Query[str] = Query("random.type", "all")
+):
+    if reach_limit(event.group_id, event.user_id):
         await essence_cmd.finish("过量抽精华有害身心健康")
-    msg = await db.random_essence(event.group_id)
+    segment_type = None if type.result == "all" else type.result
+    msg = await db.random_essence(event.group_id, segment_type)
+    if msg == None and segment_type is not None:
+        await essence_cmd.finish(f"没有包含 {segment_type} 消息的精华")
     if msg == None:
         await essence_cmd.finish(
             MessageSegment.text(
@@ -179,30 +220,68 @@ async def random_cmd(event: GroupMessageEvent, bot: Bot):
             )
         )
     elif msg[4] == "image":
-        await essence_cmd.finish(MessageSegment.image(file=msg[5]))
+        await essence_cmd.finish(await image_segment(msg[5]))
+    await essence_cmd.finish(await render_segments(bot, event.group_id, msg[2], msg[4], msg[5]))
 
 
 @essence_cmd.assign("search")
 async def search_cmd(
-    event: GroupMessageEvent, bot: Bot, keyword: Match[str] = AlconnaMatch("keyword")
+    event: GroupMessageEvent,
+    bot: Bot,
+    keyword: Match[tuple] = AlconnaMatch("keyword"),
+    sender: Query[int] = Query("search.sender.sender"),
+    page: Query[int] = Query("search.page.page", 1),
 ):
-    msg = await db.search_entries(event.group_id, keyword.result)
+    page_size = 5
+    offset = (max(page.result, 1) - 1) * page_size
+    if not keyword.result:
+        # 只给发送者时列出他所有精华里的文字, 包括多段消息中的
+        if not sender.available:
+            await essence_cmd.finish("请输入关键词或 -s QQ号")
+        rows = await db.sender_segments(
+            event.group_id, sender.result, limit=page_size, offset=offset
+        )
+        msg = [(t, event.group_id, sender.result, None, kind, data) for t, kind, data in rows]
+    else:
+        msg = await db.search_entries(
+            event.group_id,
+            " ".join(keyword.result),
+            sender_id=sender.result if sender.available else None,
+            limit=page_size,
+            offset=offset,
+        )
     if len(msg) == 0:
         await essence_cmd.finish("没有找到")
     result = []
     for _, _, sender_id, _, _, data in msg:
+        if len(data) > 100:
+            data = data[:100] + "..."
         result.append(f"{await get_name(bot, event.group_id, sender_id)}: {data}")
     await essence_cmd.finish(MessageSegment.text("\n".join(result)))
 
 
 @essence_cmd.assign("rank")
 async def rank_cmd(
-    event: GroupMessageEvent, bot: Bot, type: Query[str] = Query("~type")
+    event: GroupMessageEvent,
+    bot: Bot,
+    type: Query[str] = Query("~type"),
+    period: Query[str] = Query("rank.period", "all"),
 ):
+    today = date.today()
+    if period.result == "week":
+        since = today - timedelta(days=today.weekday())
+    elif period.result == "month":
+        since = today.replace(day=1)
+    elif period.result == "all":
+        since = None
+    else:
+        await essence_cmd.finish("时间范围只支持 week, month, all")
     if type.result == "sender":
-        rank = await db.sender_rank(event.group_id)
+        rank = await db.sender_rank(event.group_id, since)
     elif type.result == "operator":
-        rank = await db.operator_rank(event.group_id)
+        rank = await db.operator_rank(event.group_id, since)
+    else:
+        await essence_cmd.finish("排行榜类型只支持 sender, operator")
     names = await gather(*[get_name(bot, event.group_id, id) for id, _ in rank])
     result = [
         f"第{index}名: {name}, {count}条精华消息"
@@ -211,6 +290,30 @@ async def rank_cmd(
     await essence_cmd.finish(MessageSegment.text("\n".join(result)))
 
 
+@essence_cmd.assign("digest")
+async def digest_cmd(
+    event: GroupMessageEvent,
+    bot: Bot,
+    period: Query[str] = Query("digest.period", "today"),
+):
+    today = date.today()
+    end = today + timedelta(days=1)
+    if period.result == "today":
+        start, title = today, "今日"
+    elif period.result == "week":
+        start, title = today - timedelta(days=today.weekday()), "本周"
+    elif period.result == "month":
+        start, title = today.replace(day=1), "本月"
+    else:
+        try:
+            start = date.fromisoformat(period.result)
+        except ValueError:
+            await essence_cmd.finish("时间范围只支持 today, week, month 或 YYYY-MM-DD")
+        end, title = start + timedelta(days=1), f"{start} "
+    text = await render_digest(bot, event.group_id, start, end, title)
+    await essence_cmd.finish(text or "这段时间没有精华消息")
+
+
 @essence_cmd_admin.assign(
     "cancel",
 )
@@ -224,65 +327,123 @@ async def cancel_cmd(event: GroupMessageEvent, bot: Bot):
         )
 
 
+async def start_job(bot: Bot, group_id: int, kind: str, items):
+    running = jobs.running(group_id, kind)
+    if running:
+        await essence_cmd.finish(f"任务 #{running[0]} 还在进行中，可以用 essence job status 查看进度")
+    job_id = await jobs.start(bot, kind, group_id, items)
+    await essence_cmd.finish(
+        f"已创建任务 #{job_id}，共 {len(items)} 条精华消息，完成后会通知，"
+        "可以用 essence job status 查看进度"
+    )
+
+
 @essence_cmd_admin.assign("fetchall")
 async def fetchall_cmd(event: GroupMessageEvent, bot: Bot):
-    essencelist = await bot.get_essence_msg_list(group_id=event.group_id)
-    savecount = 0
-    for essence in essencelist:
-        try:
-            msg = {"message": essence["content"]}
-            msg = await format_msg(msg, bot)
-            data = [
-                essence["operator_time"],
-                event.group_id,
-                essence["sender_id"],
-                essence["operator_id"],
-                msg[0],
-                msg[1],
-            ]
-            savecount += 1
-        except:
-            continue
-        if not await db.check_entry_exists(data):
-            await db.insert_data(data)
-    await essence_cmd.finish(f"成功保存 {savecount}/{len(essencelist)} 条精华消息")
+    essencelist = await essence_lists.get(bot, event.group_id)
+    await start_job(
+        bot, event.group_id, "fetchall", [(e["message_id"], e) for e in essencelist]
+    )
 
 
 @essence_cmd_admin.assign(
     "saveall",
 )
 async def sevaall_cmd(event: GroupMessageEvent, bot: Bot):
-    essencelist = await bot.get_essence_msg_list(group_id=event.group_id)
-    savecount = await fetchpic(essencelist)
-    await essence_cmd.finish(
-        f"总共找到 {len(essencelist)} 条精华消息，成功保存 {savecount} 张图片"
+    essencelist = await essence_lists.get(bot, event.group_id)
+    await start_job(
+        bot, event.group_id, "saveall", [(e["message_id"], e) for e in essencelist]
     )
 
 
 @essence_cmd_admin.assign(
     "export",
 )
-async def export_cmd(event: GroupMessageEvent, bot: Bot):
-    path = await db.export_group_data(event.group_id)
+async def export_cmd(
+    event: GroupMessageEvent, bot: Bot, format: Query[str] = Query("export.format", "db")
+):
+    names = {"db": "essence.db", "jsonl": "essence.jsonl.gz", "zip": "essence.zip"}
+    if format.result not in names:
+        await essence_cmd.finish("导出格式只支持 db, jsonl, zip")
+    path = await db.export_group_data(event.group_id, format.result)
     try:
         await bot.upload_group_file(
-            group_id=event.group_id, file=path, name="essence.db"
+            group_id=event.group_id, file=path, name=names[format.result]
         )
-        await essence_cmd.finish(f"请检查群文件")
-    except:
-        pass
+    except Exception:
+        await essence_cmd.finish("上传群文件失败")
+    finally:
+        os.remove(path)
+    await essence_cmd.finish(f"请检查群文件")
 
 
 @essence_cmd_admin.assign(
     "clean",
 )
 async def clean_cmd(event: GroupMessageEvent, bot: Bot):
-    essencelist = await bot.get_essence_msg_list(group_id=event.group_id)
-    delcount = 0
-    for essence in essencelist:
-        try:
-            await bot.delete_essence_msg(message_id=essence["message_id"])
-            delcount += 1
-        except Exception as e:
-            continue
-    await essence_cmd.finish(f"成功删除 {delcount}/{len(essencelist)} 条精华消息")
+    essencelist = await essence_lists.get(bot, event.group_id)
+    await start_job(
+        bot,
+        event.group_id,
+        "clean",
+        [(e["message_id"], e["message_id"]) for e in essencelist],
+    )
+
+
+@essence_cmd_admin.assign(
+    "rebuild",
+)
+async def rebuild_cmd(event: GroupMessageEvent):
+    drift = await db.rebuild_rank(event.group_id)
+    await essence_cmd.finish(f"排行榜计数已重建，修正了 {drift} 处偏差")
+
+
+@essence_cmd_admin.assign(
+    "stats",
+)
+async def stats_cmd(action: Query[str] = Query("stats.action", "show")):
+    if action.result == "reset":
+        metrics.reset()
+        await essence_cmd.finish("耗时统计已清空")
+    await essence_cmd.finish(metrics.report())
+
+
+@essence_cmd_admin.assign(
+    "vacuum",
+)
+async def vacuum_cmd(event: GroupMessageEvent, bot: Bot):
+    # 作用于整个数据库, 只允许超级用户执行
+    if not await SUPERUSER(bot, event):
+        await essence_cmd.finish("只有超级用户可以整理数据库")
+    result = await db.vacuum()
+    await essence_cmd.finish(
+        f"已清理 {result['pruned']} 条取消记录，压缩 {result['compressed']} 条精华，"
+        f"回收 {result['reclaimed'] / 1048576:.2f} MiB，"
+        f"当前数据库 {result['size'] / 1048576:.2f} MiB"
+    )
+
+
+@essence_cmd_admin.assign(
+    "job",
+)
+async def job_cmd(event: GroupMessageEvent, action: Query[str] = Query("job.action", "status")):
+    if action.result != "status":
+        await essence_cmd.finish("目前只支持 essence job status")
+    rows = await db.recent_jobs(event.group_id)
+    if not rows:
+        await essence_cmd.finish("本群还没有批量任务")
+    running = jobs.running(event.group_id)
+    lines = []
+    for job_id, kind, status, total, done, failed, _, updated in rows:
+        if status == "finished":
+            state = "已完成"
+        elif job_id in running:
+            state = "进行中"
+        else:
+            state = "等待恢复"
+        lines.append(
+            f"#{job_id} {jobs.label(kind)} {state} {done}/{total}"
+            + (f"，失败 {failed}" if failed else "")
+            + f"，更新于 {time.strftime('%m-%d %H:%M:%S', time.localtime(updated))}"
+        )
+    await essence_cmd.finish("\n".join(lines))
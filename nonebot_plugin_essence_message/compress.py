@@ -0,0 +1,44 @@
+import random
+import struct
+import zlib
+
+# 压缩后的 message_data 以 BLOB 存储: 4 字节字典 id(0 表示不用字典) + raw deflate
+HEADER = struct.Struct(">I")
+DICT_SIZE = 32768
+
+
+def dict_id(zdict: bytes) -> int:
+    # 由内容决定, 分库之间拷贝数据时字典 id 不会冲突
+    return zlib.crc32(zdict) or 1
+
+
+def train_dict(samples, size: int = DICT_SIZE) -> bytes:
+    # zlib 的预设字典就是一段"之前出现过"的数据, 取去重后的样本拼接即可
+    samples = list(dict.fromkeys(s.encode("utf-8") for s in samples))
+    random.shuffle(samples)
+    return b"".join(samples)[-size:]
+
+
+def encode(text: str, zdict: bytes = None, min_bytes: int = 64):
+    # 太短或压缩后没变小的内容原样返回
+    raw = text.encode("utf-8")
+    if len(raw) < min_bytes:
+        return text
+    if zdict:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    packed = HEADER.pack(dict_id(zdict) if zdict else 0) + compressor.compress(raw)
+    packed += compressor.flush()
+    return packed if len(packed) < len(raw) else text
+
+
+def decode(value, dicts):
+    if not isinstance(value, bytes):
+        return value
+    (zdict_id,) = HEADER.unpack_from(value)
+    if zdict_id:
+        decompressor = zlib.decompressobj(-15, zdict=dicts[zdict_id])
+    else:
+        decompressor = zlib.decompressobj(-15)
+    return (decompressor.decompress(value[HEADER.size :]) + decompressor.flush()).decode("utf-8")
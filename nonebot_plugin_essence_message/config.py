@@ -7,14 +7,45 @@ from nonebot_plugin_localstore import get_data_file,get_data_dir,get_cache_dir
 
 class config(BaseModel):
     essence_random_limit: int = 5
+    essence_random_group_limit: int = 0
+    essence_random_period: int = 43200
+    essence_random_max_sessions: int = 100000
+    essence_random_persist: bool = False
     essence_enable_groups: list = ["all"]
     good_essence_rule: bool = False
     good_bound: int = 3
+    essence_good_ttl: int = 604800
+    essence_name_cache_size: int = 4096
+    essence_name_ttl: int = 3600
+    essence_job_concurrency: int = 4
+    essence_job_rate: float = 5
+    essence_job_retries: int = 3
+    essence_list_ttl: int = 10
+    essence_list_cache_size: int = 64
+    essence_reply_depth: int = 3
+    essence_reply_cache_size: int = 1024
+    essence_download_timeout: float = 15
+    essence_download_max_bytes: int = 20971520
+    essence_db_pool_size: int = 4
+    essence_write_batch_size: int = 200
+    essence_write_delay: float = 0.5
+    essence_db_sharding: bool = False
+    essence_db_max_open_shards: int = 32
+    essence_db_shard_pool_size: int = 1
+    essence_compress: bool = False
+    essence_compress_min_bytes: int = 64
+    essence_metrics: bool = True
+    essence_metrics_interval: int = 0
+    essence_digest_time: str = ""
 
     def db():
         PATH_DATA = get_data_file("essence_message", "essence_message.db")
         return PATH_DATA
     
+    def shards():
+        PATH_DATA = get_data_dir("essence_message")
+        return PATH_DATA / "shards"
+
     def img():
         PATH_DATA = get_data_dir("essence_message")
         return PATH_DATA / "img"
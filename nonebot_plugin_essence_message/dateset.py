@@ -1,171 +1,931 @@
 import aiosqlite
+import asyncio
+import hashlib
+import json
 import os
-from datetime import datetime
+import random
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 import time
+import unicodedata
+
+from nonebot import logger
+
+from .compress import decode, dict_id, encode, train_dict
+from .imgstore import REF_PATTERN, ImageStore
+from .metrics import DB_SECONDS, metrics
+from .migrations import ensure_search_index, fill_group_segments, fill_rank_counters, migrate
+from .segments import canonical_text
+
+ESSENCE_COLUMNS = "time, group_id, sender_id, operator_id, message_type, message_data"
+RANDOM_TYPES = ("text", "image")
+INSERT_COLUMNS = ESSENCE_COLUMNS + ", message_id, content_hash"
+# 读出时解码压缩过的 message_data
+SELECT_COLUMNS = ESSENCE_COLUMNS.replace(
+    "message_data", "essence_text(message_data) AS message_data"
+)
+# 有 message_id 时由唯一索引去重; 没有时沿用旧规则: 同一设精者 ±1000 秒内的同一内容只存一条
+INSERT_SQL = f"""INSERT OR IGNORE INTO essence_data ({INSERT_COLUMNS})
+    SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8
+    WHERE ?7 IS NOT NULL OR NOT EXISTS (
+        SELECT 1 FROM essence_data
+        WHERE group_id = ?2 AND content_hash = ?8
+        AND time BETWEEN ?1 - 1000 AND ?1 + 1000 AND operator_id = ?4
+    )"""
+# 旧数据没有 message_id, 同一条精华再次抓取时补上, 而不是另存一条
+ADOPT_SQL = """UPDATE OR IGNORE essence_data SET message_id = ?7 WHERE id = (
+    SELECT id FROM essence_data
+    WHERE group_id = ?2 AND content_hash = ?8 AND message_id IS NULL
+    AND time BETWEEN ?1 - 1000 AND ?1 + 1000 AND operator_id = ?4
+    ORDER BY ABS(time - ?1) LIMIT 1
+)"""
+
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+)
+
+
+def content_hash(sender_id, message_type, message_data) -> str:
+    # 同一发送者的同一内容视为同一条精华, 忽略空白和全半角差异
+    text = " ".join(unicodedata.normalize("NFKC", canonical_text(message_type, message_data)).split())
+    key = f"{sender_id}\x1f{message_type}\x1f{text}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def insert_row(data):
+    # data: [time, group_id, sender_id, operator_id, message_type, message_data(, message_id)]
+    message_id = data[6] if len(data) > 6 else None
+    return (*data[:6], message_id, content_hash(data[2], data[4], data[5]))
 
 
 class DatabaseHandler:
-    def __init__(self, db_path: str):
+    def __init__(
+        self,
+        db_path: str,
+        read_pool_size: int = 4,
+        img_store=None,
+        batch_size: int = 200,
+        batch_delay: float = 0.5,
+        compress: bool = False,
+        compress_min_bytes: int = 64,
+        flush_retries: int = 5,
+    ):
         self.db_path = db_path
+        self.img_store = img_store or ImageStore(
+            os.path.join(os.path.dirname(db_path), "img", "sha256")
+        )
+        self.read_pool_size = max(1, read_pool_size)
+        self._writer = None
+        self._readers = []
+        self._idle_readers = None
+        self._write_lock = None
+        self._opening = None
+        # group_id -> 尚未抽到的精华 id, 抽完一轮再重新洗牌
+        self._decks = {}
+        self.has_fts = False
+        # 延迟写入的 (表, 行), 按大小或时间成批提交; 超过 max_pending 时调用方等待
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay
+        self.max_pending = self.batch_size * 10
+        self._pending = []
+        self._flushing = None
+        self._flush_timer = None
+        # 队首批次连续失败的次数, 超过 flush_retries 后写入 failed_writes.jsonl 并跳过
+        self.flush_retries = max(0, flush_retries)
+        self._flush_failures = 0
+        # 字典 id -> 压缩字典; 新写入的行用 _zdict 压缩
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        self._dicts = {}
+        self._zdict = None
 
-    async def _create_table(self):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute(
-                """CREATE TABLE IF NOT EXISTS essence_data (
-                time INTEGER,
-                group_id INTEGER,
-                sender_id INTEGER,
-                operator_id INTEGER,
-                message_type TEXT,
-                message_data TEXT
-                )"""
-            )
-            await conn.execute(
-                """CREATE TABLE IF NOT EXISTS user_mapping (
-                    nickname TEXT,
-                    group_id INTEGER,
-                    user_id INTEGER,
-                    time INTEGER
-                )"""
-            )
-            await conn.execute(
-                """CREATE TABLE IF NOT EXISTS del_essence_data (
-                time INTEGER,
-                group_id INTEGER,
-                sender_id INTEGER,
-                operator_id INTEGER,
-                message_type TEXT,
-                message_data TEXT
-                )"""
-            )
-            await conn.commit()
+    async def _connect(self, readonly: bool = False):
+        # isolation_level=None: 事务由 _write() 显式 BEGIN/COMMIT 控制
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only = ON")
+        await conn.create_function("essence_hash", 3, content_hash, deterministic=True)
+        await conn.create_function("essence_text", 1, self._decode)
+        return conn
+
+    async def open(self):
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._open())
+        try:
+            await asyncio.shield(self._opening)
+        except BaseException:
+            if self._opening is not None and self._opening.done():
+                self._opening = None
+            raise
 
+    async def _open(self):
+        try:
+            self._writer = await self._connect()
+            await self._writer.execute("PRAGMA journal_mode = WAL")
+            self._write_lock = asyncio.Lock()
+            await self._migrate()
+            await self._load_dicts(self._writer)
+            self._idle_readers = asyncio.Queue()
+            for _ in range(self.read_pool_size):
+                conn = await self._connect(readonly=True)
+                self._readers.append(conn)
+                self._idle_readers.put_nowait(conn)
+        except BaseException:
+            await self._close_connections()
+            raise
+
+    async def close(self):
+        if self._opening is None:
+            return
+        try:
+            await self._opening
+        except Exception:
+            pass
+        else:
+            try:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                try:
+                    await self.flush_pending()
+                except Exception:
+                    pass
+                if self._pending:
+                    batch, self._pending = self._pending, []
+                    await self._dead_letter(batch)
+                async with self._write_lock:
+                    await self._writer.execute("PRAGMA optimize")
+            finally:
+                await self._close_connections()
+        self._opening = None
+
+    async def _close_connections(self):
+        readers, self._readers = self._readers, []
+        writer, self._writer = self._writer, None
+        self._idle_readers = None
+        self._write_lock = None
+        for conn in readers:
+            await conn.close()
+        if writer is not None:
+            await writer.close()
+
+    @asynccontextmanager
+    async def _read(self):
+        if self._idle_readers is None:
+            await self.open()
+        # 先提交还在队列里的写入, 保证读到自己的写; 提交失败时照常读取
+        if self._pending or self._flushing is not None:
+            await self._try_flush()
+        conn = await self._idle_readers.get()
+        try:
+            yield conn
+        finally:
+            self._idle_readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        if self._pending or self._flushing is not None:
+            await self._try_flush()
+        async with self._transaction() as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def _transaction(self):
+        if self._write_lock is None:
+            await self.open()
+        async with self._write_lock:
+            conn = self._writer
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            await conn.execute("COMMIT")
+
+    async def _migrate(self):
+        async with self._write_lock:
+            await migrate(self, self._writer)
+        async with self._write() as conn:
+            self.has_fts = await ensure_search_index(conn)
+
+    def _decode(self, value):
+        return decode(value, self._dicts)
+
+    async def _load_dicts(self, conn):
+        async with conn.execute("SELECT id, data FROM compress_dict ORDER BY time") as cursor:
+            for zdict_id, data in await cursor.fetchall():
+                self._dicts[zdict_id] = data
+                self._zdict = data
+
+    def _pack(self, row):
+        if not self.compress:
+            return row
+        return (*row[:5], encode(row[5], self._zdict, self.compress_min_bytes), *row[6:])
+
+    async def _index_rows(self, conn, where, params):
+        # 触发器只用内置函数: 压缩过的文字精华在这里补进全文索引, 多段消息在这里拆成分段
+        await fill_group_segments(conn, where, params)
+        if not self.has_fts:
+            return
+        await conn.execute(
+            f"""INSERT INTO essence_fts (rowid, text)
+                SELECT id, essence_text(message_data) FROM essence_data
+                WHERE {where} AND message_type = 'text' AND typeof(message_data) = 'blob'
+                AND NOT EXISTS (SELECT 1 FROM essence_fts WHERE rowid = essence_data.id)""",
+            params,
+        )
+
+    @metrics.timed(DB_SECONDS)
     async def insert_data(self, data):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute(
-                """INSERT INTO essence_data (time, group_id, sender_id, operator_id, message_type, message_data) 
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                data,
-            )
-            await conn.commit()
+        # 已存在(同一 message_id, 或旧数据里的同一条)时不插入, 返回 None
+        row = insert_row(data)
+        async with self._write() as conn:
+            if row[6] is not None:
+                await conn.execute(ADOPT_SQL, row)
+            cursor = await conn.execute(INSERT_SQL, self._pack(row))
+            essence_id = cursor.lastrowid if cursor.rowcount else None
+            if essence_id is not None:
+                await self._index_rows(conn, "id = ?", (essence_id,))
+        if essence_id is not None:
+            self._add_to_deck(data[1], essence_id, data[4])
+        return essence_id
+
+    @metrics.timed(DB_SECONDS)
+    async def insert_many(self, datas):
+        # 返回实际新增的条数, 已存在的精华跳过
+        async with self._write() as conn:
+            inserted = await self._insert_rows(conn, [insert_row(data) for data in datas])
+        return len(inserted)
 
+    async def _insert_rows(self, conn, rows):
+        async with conn.execute("SELECT IFNULL(MAX(id), 0) FROM essence_data") as cursor:
+            last_id = (await cursor.fetchone())[0]
+        await conn.executemany(ADOPT_SQL, [row for row in rows if row[6] is not None])
+        await conn.executemany(INSERT_SQL, [self._pack(row) for row in rows])
+        await self._index_rows(conn, "id > ?", (last_id,))
+        async with conn.execute(
+            "SELECT id, group_id, message_type FROM essence_data WHERE id > ?",
+            (last_id,),
+        ) as cursor:
+            inserted = await cursor.fetchall()
+        for essence_id, group_id, message_type in inserted:
+            self._add_to_deck(group_id, essence_id, message_type)
+        return inserted
+
+    @metrics.timed(DB_SECONDS)
     async def insert_del_data(self, data):
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._write() as conn:
             await conn.execute(
-                """INSERT INTO del_essence_data (time, group_id, sender_id, operator_id, message_type, message_data) 
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                data,
+                f"INSERT INTO del_essence_data ({INSERT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                insert_row(data),
+            )
+
+    async def queue_insert(self, data):
+        await self._enqueue("essence_data", data)
+
+    async def queue_del_data(self, data):
+        await self._enqueue("del_essence_data", data)
+
+    async def _enqueue(self, table, data):
+        while len(self._pending) >= self.max_pending:
+            await self._try_flush()
+            if len(self._pending) >= self.max_pending:
+                await asyncio.sleep(self.batch_delay)
+        self._pending.append((table, insert_row(data)))
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                self.batch_delay, self._start_flush
             )
-            await conn.commit()
 
+    async def flush_pending(self):
+        await asyncio.shield(self._start_flush())
+
+    async def _try_flush(self):
+        # 队列提交失败不影响本次读写; 失败已由 _flush_done 记录, 批次按定时器重试,
+        # 不在每次读写时反复重试
+        if self._flush_failures and self._flushing is None:
+            return
+        try:
+            await self.flush_pending()
+        except Exception:
+            pass
+
+    def _start_flush(self):
+        # 同时只有一个提交在跑, 它会一直写到队列为空; 等它结束即可看到之前的所有写入
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self._flush_all())
+            self._flushing.add_done_callback(self._flush_done)
+        return self._flushing
+
+    def _flush_done(self, task):
+        self._flushing = None
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.warning(
+            f"精华写入队列提交失败 ({self._flush_failures}/{self.flush_retries}): {task.exception()!r}"
+        )
+        if self._pending and self._flush_timer is None:
+            # 失败的批次已放回队首, 稍后重试
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                self.batch_delay, self._start_flush
+            )
+
+    async def _flush_all(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        while self._pending:
+            batch = self._pending[: self.batch_size]
+            del self._pending[: self.batch_size]
+            try:
+                await self._write_batch(batch)
+            except asyncio.CancelledError:
+                self._pending[:0] = batch
+                raise
+            except Exception:
+                self._flush_failures += 1
+                if self._flush_failures <= self.flush_retries:
+                    self._pending[:0] = batch
+                    raise
+                # 多次重试仍失败的批次不再阻塞后面的写入
+                self._flush_failures = 0
+                await self._dead_letter(batch)
+            else:
+                self._flush_failures = 0
+
+    async def _dead_letter(self, batch):
+        path = os.path.join(os.path.dirname(self.db_path), "failed_writes.jsonl")
+        lines = "".join(
+            json.dumps({"table": table, "row": list(row)}, ensure_ascii=False) + "\n"
+            for table, row in batch
+        )
+
+        def append():
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(lines)
+
+        await asyncio.to_thread(append)
+        logger.warning(f"{len(batch)} 条精华写入多次失败, 已保存到 {path}")
+
+    @metrics.timed(DB_SECONDS)
+    async def _write_batch(self, batch):
+        async with self._transaction() as conn:
+            # 保持入队顺序, 连续的同表行合并成一次 executemany
+            start = 0
+            for end in range(1, len(batch) + 1):
+                if end < len(batch) and batch[end][0] == batch[start][0]:
+                    continue
+                table = batch[start][0]
+                rows = [row for _, row in batch[start:end]]
+                if table == "essence_data":
+                    await self._insert_rows(conn, rows)
+                else:
+                    await conn.executemany(
+                        f"INSERT INTO {table} ({INSERT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+                start = end
+
+    @metrics.timed(DB_SECONDS)
     async def fetch_all(self):
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute("SELECT * FROM essence_data")
+        async with self._read() as conn:
+            cursor = await conn.execute(f"SELECT {SELECT_COLUMNS} FROM essence_data")
             return await cursor.fetchall()
 
+    @metrics.timed(DB_SECONDS)
     async def summary_by_date(self, date, group_id):
-        start_time = int(datetime.strptime(date, "%Y-%m-%d").timestamp())
-        end_time = start_time + 86400  # Add one day in seconds
+        start = datetime.strptime(date, "%Y-%m-%d")
+        start_time = int(start.timestamp())
+        # 右端开区间, 次日零点的精华不算在当天; 用日期加一天以兼容夏令时
+        end_time = int((start + timedelta(days=1)).timestamp())
 
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._read() as conn:
             cursor = await conn.execute(
-                "SELECT * FROM essence_data WHERE time BETWEEN ? AND ? AND group_id = ?",
-                (start_time, end_time, group_id),
+                f"""SELECT {SELECT_COLUMNS} FROM essence_data 
+                    WHERE group_id = ? AND time >= ? AND time < ?""",
+                (group_id, start_time, end_time),
             )
             return await cursor.fetchall()
 
-    async def random_essence(self, group_id):
-        async with aiosqlite.connect(self.db_path) as conn:
+    @metrics.timed(DB_SECONDS)
+    async def digest(self, group_id, start, end, top=3, samples=3):
+        # [start, end) 内的汇总, 条数和排行只读 essence_daily 和 essence_rank_daily 两张汇总表
+        days = (start.isoformat(), end.isoformat())
+        async with self._read() as conn:
             cursor = await conn.execute(
-                """SELECT * FROM essence_data 
-                   WHERE group_id = ? 
-                   AND (message_type = 'text' OR message_type = 'image') 
-                   ORDER BY RANDOM() LIMIT 1""",
-                (group_id,),
+                """SELECT message_type, SUM(count) FROM essence_daily 
+                   WHERE group_id = ? AND day >= ? AND day < ? 
+                   GROUP BY message_type""",
+                (group_id, *days),
             )
-            return await cursor.fetchone()
+            counts = dict(await cursor.fetchall())
+            ranks = {}
+            for role in ("sender", "operator"):
+                cursor = await conn.execute(
+                    """SELECT user_id, SUM(count) AS count FROM essence_rank_daily 
+                       WHERE group_id = ? AND role = ? AND day >= ? AND day < ? 
+                       GROUP BY user_id 
+                       ORDER BY count DESC 
+                       LIMIT ?""",
+                    (group_id, role, *days, top),
+                )
+                ranks[role] = await cursor.fetchall()
+            sample_rows = await self._digest_samples(conn, group_id, start, end, samples)
+        return {
+            "total": sum(counts.values()),
+            "counts": counts,
+            "senders": ranks["sender"],
+            "operators": ranks["operator"],
+            "samples": sample_rows,
+        }
 
-    async def sender_rank(self, group_id):
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute(
-                """SELECT sender_id, COUNT(*) as count 
-                   FROM essence_data 
-                   WHERE group_id = ? 
-                   GROUP BY sender_id 
-                   ORDER BY count DESC 
-                   LIMIT 7""",
-                (group_id,),
-            )
+    async def _digest_samples(self, conn, group_id, start, end, samples):
+        # 在时间范围内随机取几个起点, 各取起点之后的第一条文字精华, 每次只走一段 (group_id, time) 索引
+        low = int(datetime(start.year, start.month, start.day).timestamp())
+        high = int(datetime(end.year, end.month, end.day).timestamp())
+        rows = {}
+        if high <= low:
+            return []
+        for pivot in sorted(random.randrange(low, high) for _ in range(samples)):
+            for since, until in ((pivot, high), (low, pivot)):
+                async with conn.execute(
+                    f"""SELECT id, {SELECT_COLUMNS} FROM essence_data 
+                        WHERE group_id = ? AND time >= ? AND time < ? AND message_type = 'text' 
+                        AND id NOT IN ({", ".join("?" * len(rows))}) 
+                        ORDER BY time 
+                        LIMIT 1""",
+                    (group_id, since, until, *rows),
+                ) as cursor:
+                    row = await cursor.fetchone()
+                if row is not None:
+                    rows[row[0]] = row[1:]
+                    break
+        return sorted(rows.values())
+
+    def _add_to_deck(self, group_id, essence_id, message_type):
+        deck = self._decks.get(group_id)
+        if deck is None or message_type not in RANDOM_TYPES:
+            return
+        # 放到剩余牌堆的随机位置, 本轮之内也能抽到
+        deck.append(essence_id)
+        i = random.randrange(len(deck))
+        deck[i], deck[-1] = deck[-1], deck[i]
+
+    @metrics.timed(DB_SECONDS)
+    async def random_essence(self, group_id, segment_type=None):
+        if segment_type is not None:
+            return await self._random_with_segment(group_id, segment_type)
+        async with self._read() as conn:
+            while True:
+                deck = self._decks.get(group_id)
+                if not deck:
+                    cursor = await conn.execute(
+                        """SELECT id FROM essence_data 
+                           WHERE group_id = ? 
+                           AND message_type IN (?, ?)""",
+                        (group_id, *RANDOM_TYPES),
+                    )
+                    deck = [essence_id for essence_id, in await cursor.fetchall()]
+                    if not deck:
+                        return None
+                    random.shuffle(deck)
+                    self._decks[group_id] = deck
+                essence_id = deck.pop()
+                if not deck:
+                    del self._decks[group_id]
+                cursor = await conn.execute(
+                    f"SELECT {SELECT_COLUMNS} FROM essence_data WHERE id = ?",
+                    (essence_id,),
+                )
+                row = await cursor.fetchone()
+                await cursor.close()
+                # 已被删除的 id 在这里跳过
+                if row is not None:
+                    return row
+
+    async def _random_with_segment(self, group_id, segment_type):
+        # 含指定类型消息段的精华, 只在 essence_segment 的索引里随机
+        async with self._read() as conn:
+            async with conn.execute(
+                f"""SELECT {SELECT_COLUMNS} FROM essence_data WHERE id = (
+                        SELECT essence_id FROM (
+                            SELECT DISTINCT essence_id FROM essence_segment
+                            WHERE group_id = ? AND type = ?
+                        ) ORDER BY random() LIMIT 1
+                    )""",
+                (group_id, segment_type),
+            ) as cursor:
+                return await cursor.fetchone()
+
+    @metrics.timed(DB_SECONDS)
+    async def sender_segments(self, group_id, sender_id, segment_type="text", limit=5, offset=0):
+        # 单段消息的内容不在 essence_segment 里, 从 essence_data 取
+        async with self._read() as conn:
+            async with conn.execute(
+                """SELECT e.time, s.type, COALESCE(s.data, essence_text(e.message_data))
+                   FROM essence_segment AS s JOIN essence_data AS e ON e.id = s.essence_id
+                   WHERE s.group_id = ? AND s.sender_id = ? AND s.type = ?
+                   ORDER BY s.essence_id DESC, s.ordinal
+                   LIMIT ? OFFSET ?""",
+                (group_id, sender_id, segment_type, limit, offset),
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def _rank(self, role, group_id, since=None, limit=7):
+        async with self._read() as conn:
+            if since is None:
+                cursor = await conn.execute(
+                    """SELECT user_id, count 
+                       FROM essence_rank_total 
+                       WHERE group_id = ? AND role = ? 
+                       ORDER BY count DESC 
+                       LIMIT ?""",
+                    (group_id, role, limit),
+                )
+            else:
+                cursor = await conn.execute(
+                    """SELECT user_id, SUM(count) as count 
+                       FROM essence_rank_daily 
+                       WHERE group_id = ? AND role = ? AND day >= ? 
+                       GROUP BY user_id 
+                       ORDER BY count DESC 
+                       LIMIT ?""",
+                    (group_id, role, since.isoformat(), limit),
+                )
             return await cursor.fetchall()
 
-    async def operator_rank(self, group_id):
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute(
-                """SELECT operator_id, COUNT(*) as count 
-                   FROM essence_data 
-                   WHERE group_id = ? 
-                   GROUP BY operator_id 
-                   ORDER BY count DESC 
-                   LIMIT 7""",
-                (group_id,),
+    @metrics.timed(DB_SECONDS)
+    async def sender_rank(self, group_id, since=None, limit=7):
+        return await self._rank("sender", group_id, since, limit)
+
+    @metrics.timed(DB_SECONDS)
+    async def operator_rank(self, group_id, since=None, limit=7):
+        return await self._rank("operator", group_id, since, limit)
+
+    @metrics.timed(DB_SECONDS)
+    async def rebuild_rank(self, group_id):
+        async with self._write() as conn:
+            async with conn.execute(
+                """WITH actual AS (
+                       SELECT 'sender' AS role, sender_id AS user_id, COUNT(*) AS count
+                       FROM essence_data WHERE group_id = ? GROUP BY sender_id
+                       UNION ALL
+                       SELECT 'operator', operator_id, COUNT(*)
+                       FROM essence_data WHERE group_id = ? GROUP BY operator_id
+                   ), stored AS (
+                       SELECT role, user_id, count
+                       FROM essence_rank_total WHERE group_id = ?
+                   )
+                   SELECT COUNT(DISTINCT role || ':' || user_id) FROM (
+                       SELECT * FROM (SELECT * FROM actual EXCEPT SELECT * FROM stored)
+                       UNION ALL
+                       SELECT * FROM (SELECT * FROM stored EXCEPT SELECT * FROM actual)
+                   )""",
+                (group_id, group_id, group_id),
+            ) as cursor:
+                drift = (await cursor.fetchone())[0]
+            await conn.execute(
+                "DELETE FROM essence_rank_total WHERE group_id = ?", (group_id,)
             )
-            return await cursor.fetchall()
+            await conn.execute(
+                "DELETE FROM essence_rank_daily WHERE group_id = ?", (group_id,)
+            )
+            await fill_rank_counters(conn, group_id)
+        return drift
 
+    @metrics.timed(DB_SECONDS)
     async def delete_data_by_group(self, group_id):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute(
-                "DELETE FROM essence_data WHERE group_id = ?", (group_id,)
+        async with self._write() as conn:
+            await self._delete_group_rows(conn, group_id)
+        self._decks.pop(group_id, None)
+
+    async def _delete_group_rows(self, conn, group_id):
+        # 整群删除时先清空计数表, 否则删除触发器每行都要扫一遍该群的计数
+        for table in ("essence_rank_total", "essence_rank_daily", "essence_daily"):
+            await conn.execute(f"DELETE FROM {table} WHERE group_id = ?", (group_id,))
+        await conn.execute("DELETE FROM essence_data WHERE group_id = ?", (group_id,))
+
+    @metrics.timed(DB_SECONDS)
+    async def group_ids(self):
+        async with self._read() as conn:
+            cursor = await conn.execute(
+                """SELECT group_id FROM essence_data
+                   UNION SELECT group_id FROM del_essence_data
+                   UNION SELECT group_id FROM user_mapping"""
             )
-            await conn.commit()
+            return [group_id for group_id, in await cursor.fetchall()]
+
+    @metrics.timed(DB_SECONDS)
+    async def import_group(self, src_path, group_id):
+        # 从另一个库拷贝一个群的数据, 已有的同一条精华跳过, 重复执行不会产生重复行;
+        # 各分库的 id 各自递增, 与本库冲突的行换一个新 id
+        await self._try_flush()
+        if self._write_lock is None:
+            await self.open()
+        async with self._write_lock:
+            conn = self._writer
+            # ATTACH 不能在事务里执行
+            await conn.execute("ATTACH DATABASE ? AS src", (str(src_path),))
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # 压缩过的行要连同字典一起拷贝
+                    await conn.execute(
+                        "INSERT OR IGNORE INTO compress_dict SELECT * FROM src.compress_dict"
+                    )
+                    await self._load_dicts(conn)
+                    # 先拷贝 id 未被占用的行, 剩下的再分配新 id
+                    for new_id, free in (("s.id", "NOT EXISTS"), ("NULL", "EXISTS")):
+                        await conn.execute(
+                            f"""INSERT OR IGNORE INTO essence_data (id, {INSERT_COLUMNS})
+                                SELECT {new_id}, {INSERT_COLUMNS} FROM src.essence_data AS s
+                                WHERE s.group_id = ?1
+                                AND {free} (SELECT 1 FROM essence_data WHERE id = s.id)
+                                AND NOT EXISTS (
+                                    SELECT 1 FROM essence_data AS e
+                                    WHERE e.group_id = ?1 AND e.content_hash IS s.content_hash
+                                    AND e.time = s.time AND e.operator_id IS s.operator_id
+                                )""",
+                            (group_id,),
+                        )
+                    await self._index_rows(conn, "group_id = ?", (group_id,))
+                    await conn.execute(
+                        f"""INSERT INTO del_essence_data ({INSERT_COLUMNS})
+                            SELECT {INSERT_COLUMNS} FROM src.del_essence_data AS s
+                            WHERE s.group_id = ?1 AND NOT EXISTS (
+                                SELECT 1 FROM del_essence_data AS d
+                                WHERE d.group_id = ?1 AND d.content_hash IS s.content_hash
+                                AND d.time = s.time
+                            )""",
+                        (group_id,),
+                    )
+                    await conn.execute(
+                        """INSERT OR REPLACE INTO user_mapping (nickname, group_id, user_id, time)
+                           SELECT nickname, group_id, user_id, time FROM src.user_mapping
+                           WHERE group_id = ?""",
+                        (group_id,),
+                    )
+                except BaseException:
+                    await conn.execute("ROLLBACK")
+                    raise
+                await conn.execute("COMMIT")
+            finally:
+                await conn.execute("DETACH DATABASE src")
+        self._decks.pop(group_id, None)
 
-    async def search_entries(self, group_id, keyword):
-        keyword_escaped = keyword.replace("%", "\%").replace("_", "\_")
+    @metrics.timed(DB_SECONDS)
+    async def drop_group(self, group_id):
+        async with self._write() as conn:
+            await self._delete_group_rows(conn, group_id)
+            for table in ("del_essence_data", "user_mapping"):
+                await conn.execute(f"DELETE FROM {table} WHERE group_id = ?", (group_id,))
+        self._decks.pop(group_id, None)
 
-        async with aiosqlite.connect(self.db_path) as conn:
+    def _file_size(self):
+        return sum(
+            os.path.getsize(path)
+            for path in (str(self.db_path), f"{self.db_path}-wal")
+            if os.path.exists(path)
+        )
+
+    @metrics.timed(DB_SECONDS)
+    async def vacuum(self, batch_size: int = 500, keep_seconds: int = 86400):
+        # 清理已处理的取消记录, 按需压缩旧数据, 最后回收空闲页; 分批提交, 不长时间占住写锁
+        before = self._file_size()
+        async with self._write() as conn:
             cursor = await conn.execute(
-                """SELECT * FROM essence_data 
-                   WHERE group_id = ? 
-                   AND message_type = 'text' 
-                   AND LENGTH(message_data) <= 100 
-                   AND message_data LIKE ? ESCAPE '\\' 
-                   ORDER BY RANDOM() 
-                   LIMIT 5""",
-                (group_id, f"%{keyword_escaped}%"),
+                """DELETE FROM del_essence_data
+                   WHERE time < ? AND NOT EXISTS (
+                       SELECT 1 FROM essence_data AS e
+                       WHERE e.group_id = del_essence_data.group_id
+                       AND (e.message_id = del_essence_data.message_id
+                            OR e.content_hash = del_essence_data.content_hash)
+                   )""",
+                (int(time.time()) - keep_seconds,),
+            )
+            pruned = cursor.rowcount
+            # 其它程序直接写入的多段消息没有分段, 在这里补上
+            await fill_group_segments(conn)
+        compressed = await self._compress_rows(batch_size) if self.compress else 0
+
+        async with self._write_lock:
+            conn = self._writer
+            async with conn.execute("PRAGMA auto_vacuum") as cursor:
+                auto_vacuum = (await cursor.fetchone())[0]
+            if self.has_fts:
+                await conn.execute("INSERT INTO essence_fts (essence_fts) VALUES ('optimize')")
+            if auto_vacuum != 2:
+                # 旧库没有开启增量回收, 第一次需要整库重写
+                await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await conn.execute("VACUUM")
+            else:
+                async with conn.execute("PRAGMA incremental_vacuum") as cursor:
+                    await cursor.fetchall()
+            await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        after = self._file_size()
+        return {
+            "pruned": pruned,
+            "compressed": compressed,
+            "size": after,
+            "reclaimed": before - after,
+        }
+
+    async def _compress_rows(self, batch_size):
+        if self._zdict is None:
+            async with self._write() as conn:
+                async with conn.execute(
+                    """SELECT essence_text(message_data) FROM essence_data
+                       WHERE message_type IN ('text', 'group')
+                       ORDER BY id DESC LIMIT 2000"""
+                ) as cursor:
+                    samples = [data for data, in await cursor.fetchall()]
+                if samples:
+                    zdict = train_dict(samples)
+                    await conn.execute(
+                        "INSERT OR IGNORE INTO compress_dict (id, data, time) VALUES (?, ?, ?)",
+                        (dict_id(zdict), zdict, int(time.time())),
+                    )
+                    self._dicts[dict_id(zdict)] = zdict
+                    self._zdict = zdict
+        compressed, last_id = 0, 0
+        while True:
+            async with self._write() as conn:
+                async with conn.execute(
+                    """SELECT id, message_data FROM essence_data
+                       WHERE id > ? AND typeof(message_data) = 'text' AND length(message_data) >= ?
+                       ORDER BY id LIMIT ?""",
+                    (last_id, self.compress_min_bytes // 3, batch_size),
+                ) as cursor:
+                    rows = await cursor.fetchall()
+                if not rows:
+                    return compressed
+                last_id = rows[-1][0]
+                updates = []
+                for essence_id, data in rows:
+                    packed = encode(data, self._zdict, self.compress_min_bytes)
+                    if isinstance(packed, bytes):
+                        updates.append((packed, essence_id))
+                await conn.executemany(
+                    "UPDATE essence_data SET message_data = ? WHERE id = ?", updates
+                )
+                compressed += len(updates)
+
+    @metrics.timed(DB_SECONDS)
+    async def search_entries(
+        self, group_id, keyword, sender_id=None, limit=5, offset=0
+    ):
+        keywords = keyword.split()
+        if not keywords:
+            return []
+        # trigram 至少需要 3 个字符, 更短的关键词用 LIKE 兜底
+        long_words = [w for w in keywords if len(w) >= 3] if self.has_fts else []
+        short_words = [w for w in keywords if w not in long_words]
+        text_column = "f.text" if self.has_fts else "essence_text(e.message_data)"
+        conditions = ["e.group_id = ?", "e.message_type = 'text'"]
+        params = [group_id]
+        if long_words:
+            conditions.append("f.text MATCH ?")
+            params.append(" ".join('"%s"' % w.replace('"', '""') for w in long_words))
+        for word in short_words:
+            word = word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append(f"{text_column} LIKE ? ESCAPE '\\'")
+            params.append(f"%{word}%")
+        if sender_id is not None:
+            conditions.append("e.sender_id = ?")
+            params.append(sender_id)
+        source = (
+            "essence_fts AS f JOIN essence_data AS e ON e.id = f.rowid"
+            if self.has_fts
+            else "essence_data AS e"
+        )
+        order = "f.rank" if long_words else "e.time DESC"
+        columns = ", ".join(f"e.{c.strip()}" for c in ESSENCE_COLUMNS.split(",")).replace(
+            "e.message_data", "essence_text(e.message_data) AS message_data"
+        )
+        where = " AND ".join(conditions)
+
+        async with self._read() as conn:
+            cursor = await conn.execute(
+                f"""SELECT {columns} FROM {source}
+                    WHERE {where}
+                    ORDER BY {order}
+                    LIMIT ? OFFSET ?""",
+                (*params, limit, offset),
             )
             return await cursor.fetchall()
 
-    async def export_group_data(self, group_id):
-        export_db_path = os.path.join(
-            os.path.dirname(self.db_path), f"group_{group_id}_{int(time.time())}.db"
+    @metrics.timed(DB_SECONDS)
+    async def export_group_data(self, group_id, fmt="db"):
+        await self._try_flush()
+        base = os.path.join(
+            os.path.dirname(self.db_path), f"group_{group_id}_{int(time.time())}"
         )
+        exporters = {
+            "db": (".db", self._export_db),
+            "jsonl": (".jsonl.gz", self._export_jsonl),
+            "zip": (".zip", self._export_zip),
+        }
+        if fmt not in exporters:
+            raise ValueError(f"不支持的导出格式: {fmt}")
+        suffix, exporter = exporters[fmt]
+        export_path = base + suffix
+        try:
+            await exporter(group_id, export_path)
+        except BaseException:
+            if os.path.exists(export_path):
+                os.remove(export_path)
+            raise
+        return export_path
 
-        async with aiosqlite.connect(self.db_path) as conn:
-            async with aiosqlite.connect(export_db_path) as export_conn:
-                await export_conn.execute(
-                    """CREATE TABLE IF NOT EXISTS essence_data (
-                       time INTEGER,
-                       group_id INTEGER,
-                       sender_id INTEGER,
-                       operator_id INTEGER,
-                       message_type TEXT,
-                       message_data TEXT
-                    )"""
-                )
-                cursor = await conn.execute(
-                    "SELECT * FROM essence_data WHERE group_id = ?", (group_id,)
-                )
-                rows = await cursor.fetchall()
-                await export_conn.executemany(
-                    """INSERT INTO essence_data 
-                       (time, group_id, sender_id, operator_id, message_type, message_data) 
-                       VALUES (?, ?, ?, ?, ?, ?)""",
-                    rows,
-                )
-                await export_conn.commit()
-        return export_db_path
+    async def _export_db(self, group_id, export_path):
+        # ATTACH 后由 SQLite 内部逐行拷贝, 不经过 Python 内存
+        async with aiosqlite.connect(export_path) as export_conn:
+            await export_conn.create_function("essence_text", 1, self._decode)
+            await export_conn.execute("ATTACH DATABASE ? AS src", (str(self.db_path),))
+            await export_conn.execute(
+                """CREATE TABLE IF NOT EXISTS essence_data (
+                   time INTEGER,
+                   group_id INTEGER,
+                   sender_id INTEGER,
+                   operator_id INTEGER,
+                   message_type TEXT,
+                   message_data TEXT
+                )"""
+            )
+            await export_conn.execute(
+                f"""INSERT INTO essence_data ({ESSENCE_COLUMNS}) 
+                    SELECT {SELECT_COLUMNS} FROM src.essence_data WHERE group_id = ?""",
+                (group_id,),
+            )
+            await export_conn.commit()
+            await export_conn.execute("DETACH DATABASE src")
+
+    async def iter_group_data(self, group_id, chunk_size=500):
+        columns = [c.strip() for c in ESSENCE_COLUMNS.split(",")]
+        async with self._read() as conn:
+            async with conn.execute(
+                f"SELECT {SELECT_COLUMNS} FROM essence_data WHERE group_id = ? ORDER BY id",
+                (group_id,),
+            ) as cursor:
+                while rows := await cursor.fetchmany(chunk_size):
+                    yield [dict(zip(columns, row)) for row in rows]
 
+    async def _write_jsonl(self, group_id, f, on_row=None):
+        async for rows in self.iter_group_data(group_id):
+            if on_row is not None:
+                for row in rows:
+                    on_row(row)
+            data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+            await asyncio.to_thread(f.write, data.encode("utf-8"))
+
+    async def _export_jsonl(self, group_id, export_path):
+        import gzip
+
+        f = await asyncio.to_thread(gzip.open, export_path, "wb")
+        try:
+            await self._write_jsonl(group_id, f)
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def _export_zip(self, group_id, export_path):
+        import zipfile
+
+        digests = set()
+
+        def collect(row):
+            digests.update(REF_PATTERN.findall(str(row["message_data"])))
+
+        zf = await asyncio.to_thread(
+            zipfile.ZipFile, export_path, "w", zipfile.ZIP_DEFLATED
+        )
+        try:
+            f = await asyncio.to_thread(zf.open, "essence.jsonl", "w", force_zip64=True)
+            try:
+                await self._write_jsonl(group_id, f, collect)
+            finally:
+                await asyncio.to_thread(f.close)
+            for digest in sorted(digests):
+                path = self.img_store.path(digest)
+                if path.exists():
+                    # 图片本身已经压缩过, 直接存储
+                    await asyncio.to_thread(
+                        zf.write, path, f"images/{digest}", zipfile.ZIP_STORED
+                    )
+        finally:
+            await asyncio.to_thread(zf.close)
+
+    @metrics.timed(DB_SECONDS)
     async def get_latest_nickname(self, group_id, user_id):
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._read() as conn:
             cursor = await conn.execute(
                 """SELECT nickname, time 
                    FROM user_mapping 
@@ -175,103 +935,189 @@ class DatabaseHandler:
                 (group_id, user_id),
             )
             result = await cursor.fetchone()
+            await cursor.close()
             return result
 
     async def insert_user_mapping(self, nickname, group_id, user_id, time):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute(
+        await self.upsert_user_mappings([(nickname, group_id, user_id, time)])
+
+    @metrics.timed(DB_SECONDS)
+    async def upsert_user_mappings(self, rows):
+        async with self._write() as conn:
+            await conn.executemany(
                 """INSERT INTO user_mapping (nickname, group_id, user_id, time) 
-                   VALUES (?, ?, ?, ?)""",
-                (nickname, group_id, user_id, time),
+                   VALUES (?, ?, ?, ?) 
+                   ON CONFLICT (group_id, user_id) DO UPDATE 
+                   SET nickname = excluded.nickname, time = excluded.time""",
+                rows,
             )
-            await conn.commit()
 
+    async def _find_entry(self, conn, group_id, message_id, digest, at):
+        # 优先按 message_id 找; 找不到时按内容哈希找时间最接近的旧数据(没有 message_id 的行)
+        if message_id is not None:
+            async with conn.execute(
+                "SELECT id, operator_id FROM essence_data WHERE group_id = ? AND message_id = ?",
+                (group_id, message_id),
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                return row
+        async with conn.execute(
+            """SELECT id, operator_id FROM essence_data
+               WHERE group_id = ? AND content_hash = ? AND (? IS NULL OR message_id IS NULL)
+               ORDER BY ABS(time - ?) LIMIT 1""",
+            (group_id, digest, message_id, at),
+        ) as cursor:
+            return await cursor.fetchone()
+
+    async def _delete_entry(self, conn, essence_id):
+        async with conn.execute(
+            f"SELECT {SELECT_COLUMNS} FROM essence_data WHERE id = ?", (essence_id,)
+        ) as cursor:
+            entry = await cursor.fetchone()
+        await conn.execute("DELETE FROM essence_data WHERE id = ?", (essence_id,))
+        return entry
+
+    @metrics.timed(DB_SECONDS)
     async def delete_matching_entry(self, group_id):
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute(
-                """SELECT time, group_id, sender_id, operator_id, message_type, message_data 
+        async with self._write() as conn:
+            async with conn.execute(
+                """SELECT rowid, message_id, content_hash, time 
                    FROM del_essence_data 
                    WHERE group_id = ? 
                    ORDER BY time DESC 
                    LIMIT 1""",
                 (group_id,),
-            )
-            latest_del_entry = await cursor.fetchone()
+            ) as cursor:
+                latest_del_entry = await cursor.fetchone()
             if not latest_del_entry:
                 return None
 
-            del_time, _, sender_id, operator_id, message_type, message_data = (
-                latest_del_entry
+            del_rowid, message_id, digest, del_time = latest_del_entry
+            found = await self._find_entry(conn, group_id, message_id, digest, del_time)
+            if found is None:
+                return None
+            await conn.execute(
+                "DELETE FROM del_essence_data WHERE rowid = ?", (del_rowid,)
             )
-            message_data = message_data[:50]
+            return await self._delete_entry(conn, found[0])
+
+    @metrics.timed(DB_SECONDS)
+    async def delete_entry(self, data, operator_id=None):
+        # 删除与 data 对应的那条精华, 指定 operator_id 时只删该用户设的精华
+        row = insert_row(data)
+        async with self._write() as conn:
+            found = await self._find_entry(conn, row[1], row[6], row[7], row[0])
+            if found is None or operator_id not in (None, found[1]):
+                return None
+            return await self._delete_entry(conn, found[0])
+
+    @metrics.timed(DB_SECONDS)
+    async def check_entry_exists(self, data, operator_id=None):
+        row = insert_row(data)
+        async with self._read() as conn:
+            found = await self._find_entry(conn, row[1], row[6], row[7], row[0])
+        return found is not None and operator_id in (None, found[1])
 
+    @metrics.timed(DB_SECONDS)
+    async def load_good_counts(self, since):
+        async with self._read() as conn:
             cursor = await conn.execute(
-                """SELECT * 
-                   FROM essence_data 
-                   WHERE group_id = ? 
-                   AND sender_id = ? 
-                   AND operator_id = ? 
-                   AND message_type = ? 
-                   AND message_data LIKE ? 
-                   ORDER BY ABS(time - ?) 
-                   LIMIT 1""",
-                (
-                    group_id,
-                    sender_id,
-                    operator_id,
-                    message_type,
-                    f"{message_data}%",
-                    del_time,
-                ),
+                "SELECT key, count, time FROM good_count WHERE time >= ?", (since,)
             )
-            matching_entry = await cursor.fetchone()
-            if matching_entry:
-                await conn.execute(
-                    """DELETE FROM essence_data 
-                       WHERE time = ? 
-                       AND group_id = ? 
-                       AND sender_id = ? 
-                       AND operator_id = ? 
-                       AND message_type = ? 
-                       AND message_data = ?""",
-                    matching_entry,
-                )
-                await conn.execute(
-                    """DELETE FROM del_essence_data 
-                       WHERE time = ? 
-                       AND group_id = ? 
-                       AND sender_id = ? 
-                       AND operator_id = ? 
-                       AND message_type = ? 
-                       AND message_data = ?""",
-                    matching_entry,
-                )
-                await conn.commit()
-            return matching_entry
+            return await cursor.fetchall()
 
-    async def check_entry_exists(self, data):
-        operator_time, group_id, sender_id, operator_id, message_type, message_data = (
-            data
-        )
+    @metrics.timed(DB_SECONDS)
+    async def save_good_counts(self, rows, expire_before):
+        async with self._write() as conn:
+            await conn.executemany(
+                """INSERT INTO good_count (key, count, time) VALUES (?, ?, ?)
+                   ON CONFLICT (key) DO UPDATE SET count = excluded.count, time = excluded.time""",
+                rows,
+            )
+            await conn.execute(
+                "DELETE FROM good_count WHERE count <= 0 OR time < ?", (expire_before,)
+            )
 
-        async with aiosqlite.connect(self.db_path) as conn:
+    @metrics.timed(DB_SECONDS)
+    async def create_job(self, kind, group_id, self_id, items):
+        # items: [(唯一键, 可 JSON 序列化的参数), ...]
+        now = int(time.time())
+        async with self._write() as conn:
             cursor = await conn.execute(
-                """SELECT COUNT(*) 
-                   FROM essence_data 
-                   WHERE group_id = ? 
-                   AND sender_id = ? 
-                   AND operator_id = ? 
-                   AND message_type = ? 
-                   AND message_data LIKE ? 
-                   AND time BETWEEN ? AND ?""",
-                (
-                    group_id,
-                    sender_id,
-                    operator_id,
-                    message_type,
-                    message_data[:50],
-                    operator_time - 1000,
-                    operator_time + 1000,
-                ),
+                """INSERT INTO job (kind, group_id, self_id, status, total, created, updated)
+                   VALUES (?, ?, ?, 'running', ?, ?, ?)""",
+                (kind, group_id, str(self_id), len(items), now, now),
             )
-            return (await cursor.fetchone())[0] > 0
+            job_id = cursor.lastrowid
+            await conn.executemany(
+                "INSERT OR IGNORE INTO job_item (job_id, item_key, payload) VALUES (?, ?, ?)",
+                [(job_id, str(key), json.dumps(payload)) for key, payload in items],
+            )
+        return job_id
+
+    @metrics.timed(DB_SECONDS)
+    async def running_jobs(self, self_id=None):
+        async with self._read() as conn:
+            cursor = await conn.execute(
+                """SELECT id, kind, group_id, self_id, total, done + failed FROM job
+                   WHERE status = 'running' AND (? IS NULL OR self_id = ?)
+                   ORDER BY id""",
+                (self_id, None if self_id is None else str(self_id)),
+            )
+            return await cursor.fetchall()
+
+    @metrics.timed(DB_SECONDS)
+    async def pending_job_items(self, job_id):
+        async with self._read() as conn:
+            cursor = await conn.execute(
+                """SELECT item_key, payload, attempts FROM job_item
+                   WHERE job_id = ? AND status = 'pending'""",
+                (job_id,),
+            )
+            return [
+                (key, json.loads(payload), attempts)
+                for key, payload, attempts in await cursor.fetchall()
+            ]
+
+    @metrics.timed(DB_SECONDS)
+    async def update_job_items(self, job_id, results):
+        # results: [(唯一键, 状态, 已尝试次数, 错误), ...]
+        async with self._write() as conn:
+            await conn.executemany(
+                """UPDATE job_item SET status = ?, attempts = ?, error = ?
+                   WHERE job_id = ? AND item_key = ?""",
+                [(status, attempts, error, job_id, key) for key, status, attempts, error in results],
+            )
+            await conn.execute(
+                """UPDATE job SET
+                   done = (SELECT COUNT(*) FROM job_item WHERE job_id = job.id AND status = 'done'),
+                   failed = (SELECT COUNT(*) FROM job_item WHERE job_id = job.id AND status = 'failed'),
+                   updated = ?
+                   WHERE id = ?""",
+                (int(time.time()), job_id),
+            )
+
+    @metrics.timed(DB_SECONDS)
+    async def finish_job(self, job_id):
+        # 完成后只保留汇总, 逐项记录删除
+        async with self._write() as conn:
+            await conn.execute(
+                "UPDATE job SET status = 'finished', updated = ? WHERE id = ?",
+                (int(time.time()), job_id),
+            )
+            await conn.execute("DELETE FROM job_item WHERE job_id = ?", (job_id,))
+            async with conn.execute(
+                "SELECT total, done, failed FROM job WHERE id = ?", (job_id,)
+            ) as cursor:
+                return await cursor.fetchone()
+
+    @metrics.timed(DB_SECONDS)
+    async def recent_jobs(self, group_id, limit=5):
+        async with self._read() as conn:
+            cursor = await conn.execute(
+                """SELECT id, kind, status, total, done, failed, created, updated
+                   FROM job WHERE group_id = ? ORDER BY id DESC LIMIT ?""",
+                (group_id, limit),
+            )
+            return await cursor.fetchall()
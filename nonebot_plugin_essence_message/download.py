@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+from .metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS, metrics
+
+if TYPE_CHECKING:
+    import httpx
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class Downloader:
+    def __init__(
+        self,
+        timeout: float = 15,
+        max_bytes: int = 20 * 1024 * 1024,
+        retries: int = 3,
+        max_connections: int = 16,
+    ):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.max_connections = max_connections
+        self._client = None
+
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        # 在事件循环里第一次用到时再创建, 整个进程共用一个连接池
+        # httpx 导入较慢, 也推迟到这里
+        if self._client is None:
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=5),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    async def fetch(self, url: str, directory: Path):
+        # 流式写入 directory 下的临时文件, 边下边算 sha256, 返回 (路径, sha256)
+        import httpx
+
+        host = urlsplit(url).hostname or "unknown"
+        with metrics.timer(DOWNLOAD_SECONDS, host):
+            for attempt in range(self.retries + 1):
+                try:
+                    return await self._fetch(url, directory, host)
+                except (httpx.TransportError, DownloadError) as e:
+                    retryable = not isinstance(e, DownloadError) or e.retryable
+                    if not retryable or attempt == self.retries:
+                        raise DownloadError(f"下载失败: {url}") from e
+                await asyncio.sleep(0.5 * 2**attempt)
+
+    async def _fetch(self, url: str, directory: Path, host: str):
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with self.client.stream("GET", url) as r:
+                    if r.status_code != 200:
+                        raise DownloadError(
+                            f"HTTP {r.status_code}: {url}", r.status_code in RETRY_STATUS
+                        )
+                    if int(r.headers.get("content-length", 0)) > self.max_bytes:
+                        raise DownloadError(f"文件超过 {self.max_bytes} 字节")
+                    async for chunk in r.aiter_bytes(64 * 1024):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise DownloadError(f"文件超过 {self.max_bytes} 字节")
+                        digest.update(chunk)
+                        f.write(chunk)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            if metrics.enabled:
+                DOWNLOAD_BYTES.inc(host, size)
+        return Path(tmp), digest.hexdigest()
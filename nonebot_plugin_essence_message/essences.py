@@ -0,0 +1,62 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from nonebot.adapters.onebot.v11.bot import Bot
+
+
+class EssenceListCache:
+    def __init__(self, ttl: float = 10, min_refresh: float = 1, max_groups: int = 64):
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.max_groups = max(1, max_groups)
+        # group_id -> (获取时间, 精华列表, message_id -> 精华), 按最近使用排序
+        self._lists = OrderedDict()
+        self._fetching = {}
+
+    async def get(self, bot: Bot, group_id: int, max_age: float = None) -> list:
+        return (await self._entry(bot, group_id, max_age))[1]
+
+    async def find(self, bot: Bot, group_id: int, message_id: int):
+        entry = await self._entry(bot, group_id)
+        essence = entry[2].get(message_id)
+        # 刚设的精华可能不在缓存里, 重新拉一次, 但不要过于频繁
+        if essence is None and time.monotonic() - entry[0] > self.min_refresh:
+            entry = await self._entry(bot, group_id, self.min_refresh)
+            essence = entry[2].get(message_id)
+        return essence
+
+    def invalidate(self, group_id: int):
+        self._lists.pop(group_id, None)
+
+    async def _entry(self, bot: Bot, group_id: int, max_age: float = None):
+        max_age = self.ttl if max_age is None else max_age
+        entry = self._lists.get(group_id)
+        if entry is not None and time.monotonic() - entry[0] <= max_age:
+            self._lists.move_to_end(group_id)
+            return entry
+        # 同一个群同时只有一个请求在拉列表, 其余的等它的结果
+        task = self._fetching.get(group_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(bot, group_id))
+            self._fetching[group_id] = task
+            task.add_done_callback(lambda _: self._fetching.pop(group_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot: Bot, group_id: int):
+        fetched = time.monotonic()
+        essencelist = await bot.get_essence_msg_list(group_id=group_id)
+        entry = (
+            fetched,
+            essencelist,
+            {essence["message_id"]: essence for essence in essencelist},
+        )
+        self._lists[group_id] = entry
+        self._lists.move_to_end(group_id)
+        # 过期的列表不会再被用到, 先清掉; 仍超出上限时去掉最久未用的群
+        now = time.monotonic()
+        for key in [k for k, v in self._lists.items() if now - v[0] > self.ttl]:
+            del self._lists[key]
+        while len(self._lists) > self.max_groups:
+            self._lists.popitem(last=False)
+        return entry
@@ -0,0 +1,76 @@
+import asyncio
+import json
+from collections import OrderedDict
+
+from nonebot.adapters.onebot.v11.bot import Bot
+
+from .download import DownloadError
+
+# 各类消息段里用来代表内容的字段, 未列出的类型依次尝试 FALLBACK_KEYS
+SEGMENT_KEYS = {"text": "text", "at": "qq", "face": "id", "forward": "id"}
+FALLBACK_KEYS = ("summary", "text", "file", "url", "id")
+
+
+class MessageFormatter:
+    def __init__(self, download, max_depth: int = 3, cache_size: int = 1024):
+        self.download = download
+        self.max_depth = max_depth
+        self.cache_size = cache_size
+        # (message_id, 深度) -> 格式化后的被回复消息, 按最近使用排序
+        self._replies = OrderedDict()
+        self._resolving = {}
+
+    async def format(self, msg, bot: Bot, depth: int = 0):
+        # 图片下载失败时整条消息返回 None
+        segments = msg["message"]
+        if isinstance(segments, str):
+            segments = [{"type": "text", "data": {"text": segments}}]
+        try:
+            result = await asyncio.gather(
+                *(self._segment(segment, bot, depth) for segment in segments)
+            )
+        except DownloadError:
+            return None
+        if len(result) == 1:
+            return result[0]
+        # 多段消息存为 [[类型, 内容], ...] 的 JSON, 内容里的逗号和方括号不会和分隔符混淆
+        return ["group", json.dumps([[t, str(d)] for t, d in result], ensure_ascii=False)]
+
+    async def _segment(self, segment, bot: Bot, depth: int):
+        kind, data = segment["type"], segment.get("data") or {}
+        if kind == "image":
+            return [kind, await self.download(data["url"])]
+        if kind == "reply":
+            return [kind, await self._reply(bot, data["id"], depth + 1)]
+        key = SEGMENT_KEYS.get(kind)
+        if key is None:
+            key = next((k for k in FALLBACK_KEYS if data.get(k)), None)
+        return [kind, data.get(key, "") if key else ""]
+
+    async def _reply(self, bot: Bot, message_id, depth: int) -> str:
+        if depth > self.max_depth:
+            return "[]"
+        key = (message_id, depth)
+        if key in self._replies:
+            self._replies.move_to_end(key)
+            return self._replies[key]
+        # 同一条被回复的消息同时只解析一次
+        task = self._resolving.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._resolve(bot, message_id, depth))
+            self._resolving[key] = task
+            task.add_done_callback(lambda _: self._resolving.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _resolve(self, bot: Bot, message_id, depth: int) -> str:
+        try:
+            msg = await bot.get_msg(message_id=message_id)
+            formatted = await self.format(msg, bot, depth)
+            text = f"[{formatted[0]},{formatted[1]}]"
+        except Exception:
+            # 拿不到的消息不缓存, 下次再试
+            return "[]"
+        self._replies[(message_id, depth)] = text
+        while len(self._replies) > self.cache_size:
+            self._replies.popitem(last=False)
+        return text
@@ -0,0 +1,78 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import re
+from pathlib import Path
+
+REF_PREFIX = "sha256://"
+BASE64_PATTERN = re.compile(r"base64://([A-Za-z0-9+/=]+)")
+# 多段消息和回复里内嵌的图片段, 文字段中的 base64:// 不是图片
+IMAGE_SEGMENT_PATTERN = re.compile(r"\[image,base64://([A-Za-z0-9+/=]+)\]")
+REF_PATTERN = re.compile(r"sha256://([0-9a-f]{64})")
+
+
+class ImageStore:
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, ref: str) -> Path:
+        digest = ref[len(REF_PREFIX) :] if ref.startswith(REF_PREFIX) else ref
+        return self.root / digest[:2] / digest
+
+    def _put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{digest}.{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        return REF_PREFIX + digest
+
+    async def put(self, data: bytes) -> str:
+        return await asyncio.to_thread(self._put, data)
+
+    @property
+    def tmp_dir(self) -> Path:
+        return self.root / "tmp"
+
+    def _adopt(self, tmp: Path, digest: str) -> str:
+        path = self.path(digest)
+        if path.exists():
+            tmp.unlink()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, path)
+        return REF_PREFIX + digest
+
+    async def adopt(self, tmp: Path, digest: str) -> str:
+        # 接管 tmp_dir 下已经算好哈希的下载文件
+        return await asyncio.to_thread(self._adopt, tmp, digest)
+
+    async def load(self, ref: str):
+        # 旧数据里可能还有 base64:// 或 url, 原样交给 MessageSegment.image
+        if not ref.startswith(REF_PREFIX):
+            return ref
+        return await asyncio.to_thread(self.path(ref).read_bytes)
+
+    def _inline_ref(self, data: str):
+        # 解不开的内容原样保留, 返回 None
+        try:
+            return self._put(base64.b64decode(data, validate=True))
+        except (binascii.Error, ValueError):
+            return None
+
+    def inline_to_ref(self, message_type: str, message_data: str) -> str:
+        if message_type == "image":
+            match = BASE64_PATTERN.fullmatch(message_data)
+            ref = match and self._inline_ref(match.group(1))
+            return ref or message_data
+        if message_type in ("group", "reply"):
+            return IMAGE_SEGMENT_PATTERN.sub(self._segment_ref, message_data)
+        return message_data
+
+    def _segment_ref(self, match) -> str:
+        ref = self._inline_ref(match.group(1))
+        return f"[image,{ref}]" if ref else match.group(0)
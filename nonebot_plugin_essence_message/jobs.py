@@ -0,0 +1,172 @@
+import asyncio
+import time
+
+from nonebot import logger
+from nonebot.adapters.onebot.v11.bot import Bot
+
+
+class JobRunner:
+    def __init__(
+        self,
+        db,
+        concurrency: int = 4,
+        retries: int = 3,
+        backoff: float = 1,
+        checkpoint_every: int = 20,
+        progress_every: int = 100,
+    ):
+        self.db = db
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.progress_every = progress_every
+        # kind -> (名称, 处理单项的协程函数, 完成后的回调, 每批结果的回调, 每秒调用次数)
+        self._kinds = {}
+        # job_id -> (task, group_id, kind)
+        self._tasks = {}
+        self._next_call = 0
+
+    def register(
+        self,
+        kind: str,
+        label: str,
+        handler,
+        on_finish=None,
+        on_batch=None,
+        rate: float = 0,
+    ):
+        # handler(bot, group_id, payload) 抛出异常即视为失败, 按退避重试;
+        # on_batch(bot, group_id, 返回值列表) 在每次写入进度前处理这一批成功项的返回值, 返回新增条数;
+        # rate 限制调用 OneBot 接口的任务每秒最多处理几项, 0 表示不限
+        self._kinds[kind] = (label, handler, on_finish, on_batch, rate)
+
+    def label(self, kind: str) -> str:
+        return self._kinds[kind][0] if kind in self._kinds else kind
+
+    def running(self, group_id: int, kind: str = None):
+        return [
+            job_id
+            for job_id, (_, task_group, task_kind) in self._tasks.items()
+            if task_group == group_id and kind in (None, task_kind)
+        ]
+
+    async def start(self, bot: Bot, kind: str, group_id: int, items):
+        job_id = await self.db.create_job(kind, group_id, bot.self_id, items)
+        self._spawn(bot, job_id, kind, group_id, len(items), 0)
+        return job_id
+
+    async def resume(self, bot: Bot):
+        # bot 重新连上时继续它名下未完成的任务
+        for job_id, kind, group_id, _, total, processed in await self.db.running_jobs(
+            bot.self_id
+        ):
+            if job_id not in self._tasks and kind in self._kinds:
+                logger.info(f"继续未完成的任务 #{job_id} ({kind}, 群 {group_id})")
+                self._spawn(bot, job_id, kind, group_id, total, processed)
+
+    async def close(self):
+        tasks = [task for task, _, _ in self._tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, bot: Bot, job_id: int, kind: str, group_id: int, total: int, processed: int):
+        task = asyncio.create_task(self._run(bot, job_id, kind, group_id, total, processed))
+        self._tasks[job_id] = (task, group_id, kind)
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _pace(self, rate: float):
+        if rate <= 0:
+            return
+        now = time.monotonic()
+        at = max(now, self._next_call)
+        self._next_call = at + 1 / rate
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _notify(self, bot: Bot, job_id: int, group_id: int, message: str):
+        try:
+            await bot.send_group_msg(group_id=group_id, message=message)
+        except Exception as e:
+            logger.warning(f"任务 #{job_id} 的通知发送失败: {e!r}")
+
+    async def _run(self, bot: Bot, job_id: int, kind: str, group_id: int, total: int, processed: int):
+        label, handler, on_finish, on_batch, rate = self._kinds[kind]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        results = []
+        values = []
+        handled = 0
+        added = 0
+
+        async def checkpoint():
+            nonlocal added
+            if not results:
+                return
+            batch, batch_values = results[:], values[:]
+            results.clear()
+            values.clear()
+            if on_batch is not None and batch_values:
+                try:
+                    count = await on_batch(bot, group_id, batch_values)
+                    added += count or 0
+                except Exception as e:
+                    # 这一批没有写入, 成功项也记为失败
+                    logger.warning(f"任务 #{job_id} ({kind}) 写入失败: {e!r}")
+                    batch = [
+                        (key, "failed", attempts, error or repr(e))
+                        for key, _, attempts, error in batch
+                    ]
+            await self.db.update_job_items(job_id, batch)
+
+        async def run_item(key, payload, attempts):
+            nonlocal handled
+            async with semaphore:
+                while True:
+                    await self._pace(rate)
+                    attempts += 1
+                    try:
+                        value = await handler(bot, group_id, payload)
+                    except Exception as e:
+                        if attempts <= self.retries:
+                            await asyncio.sleep(self.backoff * 2 ** (attempts - 1))
+                            continue
+                        results.append((key, "failed", attempts, repr(e)))
+                    else:
+                        results.append((key, "done", attempts, None))
+                        if value is not None:
+                            values.append(value)
+                    break
+            handled += 1
+            # 在 await 之前取值, 其它项在等待期间还会继续累加
+            count = processed + handled
+            if len(results) >= self.checkpoint_every:
+                await checkpoint()
+            if self.progress_every and count % self.progress_every == 0 and count < total:
+                await self._notify(
+                    bot, job_id, group_id, f"任务 #{job_id} {label}: 已处理 {count}/{total} 条"
+                )
+
+        try:
+            items = await self.db.pending_job_items(job_id)
+            try:
+                await asyncio.gather(*(run_item(*item) for item in items))
+            finally:
+                # 被取消(关闭)时也把已完成的项写入, 下次从剩下的继续
+                await checkpoint()
+            total, done, failed = await self.db.finish_job(job_id)
+            if on_finish is not None:
+                await on_finish(bot, group_id)
+            elapsed = time.perf_counter() - started
+            message = f"任务 #{job_id} {label}已完成: 成功 {done}/{total}"
+            if failed:
+                message += f"，失败 {failed}"
+            if on_batch is not None:
+                message += f"，新增 {added} 条"
+            message += f"\n耗时 {elapsed:.1f} 秒, {handled / max(elapsed, 0.001):.1f} 条/秒"
+            await self._notify(bot, job_id, group_id, message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"任务 #{job_id} ({kind}) 出错: {e!r}")
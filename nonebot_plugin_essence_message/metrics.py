@@ -0,0 +1,205 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+# 桶的上界(秒), 最后还有一个 +Inf 桶
+BUCKETS = (
+    0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+    0.1, 0.2, 0.5, 1, 2, 5, 10, 30,
+)
+
+
+class Histogram:
+    def __init__(self, name: str, label: str, help: str):
+        self.name = name
+        self.label = label
+        self.help = help
+        # 标签值 -> [各桶计数..., 总次数, 总耗时, 最大耗时, 失败次数]
+        self.series = {}
+
+    def observe(self, value: str, seconds: float, failed: bool = False):
+        s = self.series.get(value)
+        if s is None:
+            s = self.series[value] = [0] * (len(BUCKETS) + 1) + [0, 0.0, 0.0, 0]
+        s[bisect_left(BUCKETS, seconds)] += 1
+        n = len(BUCKETS) + 1
+        s[n] += 1
+        s[n + 1] += seconds
+        if seconds > s[n + 2]:
+            s[n + 2] = seconds
+        if failed:
+            s[n + 3] += 1
+
+    def stats(self, value: str):
+        s = self.series[value]
+        n = len(BUCKETS) + 1
+        count, total, peak, errors = s[n : n + 4]
+        return {
+            "count": count,
+            "total": total,
+            "max": peak,
+            "errors": errors,
+            "p50": self._quantile(s, count, peak, 0.5),
+            "p99": self._quantile(s, count, peak, 0.99),
+        }
+
+    @staticmethod
+    def _quantile(s, count, peak, q):
+        # 在所在的桶内线性插值, 结果不超过观测到的最大值
+        rank = q * count
+        seen = 0
+        for i, upper in enumerate(BUCKETS + (peak,)):
+            if seen + s[i] >= rank and s[i]:
+                lower = BUCKETS[i - 1] if i else 0
+                upper = min(upper, peak)
+                return lower + (upper - lower) * (rank - seen) / s[i]
+            seen += s[i]
+        return peak
+
+
+class Counter:
+    def __init__(self, name: str, label: str, help: str):
+        self.name = name
+        self.label = label
+        self.help = help
+        self.series = {}
+
+    def inc(self, value: str, amount: float = 1):
+        self.series[value] = self.series.get(value, 0) + amount
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.started = time.time()
+        self.families = []
+
+    def histogram(self, name: str, label: str, help: str) -> Histogram:
+        family = Histogram(name, label, help)
+        self.families.append(family)
+        return family
+
+    def counter(self, name: str, label: str, help: str) -> Counter:
+        family = Counter(name, label, help)
+        self.families.append(family)
+        return family
+
+    def reset(self):
+        self.started = time.time()
+        for family in self.families:
+            family.series.clear()
+
+    @contextmanager
+    def timer(self, histogram: Histogram, value: str):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            histogram.observe(value, time.perf_counter() - started, failed)
+
+    def timed(self, histogram: Histogram, value: str = None):
+        # 装饰协程函数, 标签默认为函数名; 关闭统计时只多一次判断
+        def decorator(func):
+            label = value or func.__name__
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                failed = True
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    histogram.observe(label, time.perf_counter() - started, failed)
+
+            return wrapper
+
+        return decorator
+
+    def report(self, limit: int = 5) -> str:
+        # 每类只列出总耗时最多的几项
+        uptime = int(time.time() - self.started)
+        lines = [f"统计时长 {uptime // 3600}时{uptime % 3600 // 60}分"]
+        for family in self.families:
+            if not isinstance(family, Histogram) or not family.series:
+                continue
+            lines.append(f"[{family.help}] 次数 p50/p99/max(ms) 失败")
+            rows = sorted(
+                ((value, family.stats(value)) for value in family.series),
+                key=lambda item: item[1]["total"],
+                reverse=True,
+            )
+            for value, stats in rows[:limit]:
+                lines.append(
+                    f"{value}: {stats['count']} "
+                    f"{stats['p50'] * 1000:.1f}/{stats['p99'] * 1000:.1f}/{stats['max'] * 1000:.1f} "
+                    f"{stats['errors']}"
+                )
+        if len(lines) == 1:
+            lines.append("暂无数据" if self.enabled else "统计未开启")
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for family in self.families:
+            if isinstance(family, Counter):
+                lines.append(f"# HELP {family.name} {family.help}")
+                lines.append(f"# TYPE {family.name} counter")
+                for value, amount in sorted(family.series.items()):
+                    lines.append(f'{family.name}{{{family.label}="{_escape(value)}"}} {amount}')
+                continue
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} histogram")
+            for value in sorted(family.series):
+                s = family.series[value]
+                label = f'{family.label}="{_escape(value)}"'
+                cumulative = 0
+                for upper, count in zip(BUCKETS, s):
+                    cumulative += count
+                    lines.append(f'{family.name}_bucket{{{label},le="{upper}"}} {cumulative}')
+                stats = family.stats(value)
+                lines.append(f'{family.name}_bucket{{{label},le="+Inf"}} {stats["count"]}')
+                lines.append(f"{family.name}_sum{{{label}}} {stats['total']}")
+                lines.append(f"{family.name}_count{{{label}}} {stats['count']}")
+            errors = family.name.rsplit("_seconds", 1)[0] + "_errors_total"
+            lines.append(f"# TYPE {errors} counter")
+            for value in sorted(family.series):
+                lines.append(
+                    f'{errors}{{{family.label}="{_escape(value)}"}} {family.stats(value)["errors"]}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path):
+        # 先写临时文件再替换, 避免采集端读到半个文件
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(self.render_prometheus(), encoding="utf-8")
+        os.replace(tmp, path)
+
+
+metrics = Metrics()
+HANDLER_SECONDS = metrics.histogram(
+    "essence_handler_seconds", "handler", "事件处理器耗时"
+)
+DB_SECONDS = metrics.histogram("essence_db_seconds", "query", "数据库方法耗时")
+API_SECONDS = metrics.histogram("essence_api_seconds", "api", "Bot API 调用耗时")
+DOWNLOAD_SECONDS = metrics.histogram(
+    "essence_download_seconds", "host", "图片下载耗时(含重试)"
+)
+DOWNLOAD_BYTES = metrics.counter(
+    "essence_download_bytes_total", "host", "图片下载字节数"
+)
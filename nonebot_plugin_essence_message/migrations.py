@@ -0,0 +1,544 @@
+import aiosqlite
+import asyncio
+
+from .segments import segment_rows
+
+
+async def _v1_base_tables(db, conn):
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS essence_data (
+        time INTEGER,
+        group_id INTEGER,
+        sender_id INTEGER,
+        operator_id INTEGER,
+        message_type TEXT,
+        message_data TEXT
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS user_mapping (
+            nickname TEXT,
+            group_id INTEGER,
+            user_id INTEGER,
+            time INTEGER
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS del_essence_data (
+        time INTEGER,
+        group_id INTEGER,
+        sender_id INTEGER,
+        operator_id INTEGER,
+        message_type TEXT,
+        message_data TEXT
+        )"""
+    )
+
+
+async def _v2_primary_key_and_indexes(db, conn):
+    # 显式 INTEGER PRIMARY KEY, 保留原 rowid, 之后 VACUUM 也不会重排
+    await conn.execute("ALTER TABLE essence_data RENAME TO essence_data_v1")
+    await conn.execute(
+        """CREATE TABLE essence_data (
+        time INTEGER,
+        group_id INTEGER,
+        sender_id INTEGER,
+        operator_id INTEGER,
+        message_type TEXT,
+        message_data TEXT,
+        id INTEGER PRIMARY KEY
+        )"""
+    )
+    await conn.execute(
+        """INSERT INTO essence_data
+           (id, time, group_id, sender_id, operator_id, message_type, message_data)
+           SELECT rowid, time, group_id, sender_id, operator_id, message_type, message_data
+           FROM essence_data_v1"""
+    )
+    await conn.execute("DROP TABLE essence_data_v1")
+
+    await conn.execute(
+        "CREATE INDEX idx_essence_group_time ON essence_data (group_id, time)"
+    )
+    await conn.execute(
+        """CREATE INDEX idx_essence_group_sender
+           ON essence_data (group_id, sender_id, time)"""
+    )
+    await conn.execute(
+        """CREATE INDEX idx_essence_group_operator
+           ON essence_data (group_id, operator_id, time)"""
+    )
+    await conn.execute(
+        "CREATE INDEX idx_del_essence_group_time ON del_essence_data (group_id, time)"
+    )
+    await conn.execute(
+        """CREATE INDEX idx_user_mapping_latest
+           ON user_mapping (group_id, user_id, time DESC, nickname)"""
+    )
+
+
+async def _v3_images_to_store(db, conn):
+    # 图片消息和多段消息里的 base64 图片落盘到内容寻址存储, 行内只保留 sha256:// 引用;
+    # 文字里的 base64:// 和解不开的内容保持原样
+    for table, key in (("essence_data", "id"), ("del_essence_data", "rowid")):
+        last = 0
+        while True:
+            async with conn.execute(
+                f"""SELECT {key}, message_type, message_data FROM {table}
+                    WHERE {key} > ? AND message_type IN ('image', 'group', 'reply')
+                    AND instr(message_data, 'base64://') > 0
+                    ORDER BY {key} LIMIT 64""",
+                (last,),
+            ) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+            for row_id, message_type, message_data in rows:
+                converted = await asyncio.to_thread(
+                    db.img_store.inline_to_ref, message_type, message_data
+                )
+                if converted != message_data:
+                    await conn.execute(
+                        f"UPDATE {table} SET message_data = ? WHERE {key} = ?",
+                        (converted, row_id),
+                    )
+            last = rows[-1][0]
+
+
+async def _v4_random_index(db, conn):
+    await conn.execute(
+        "CREATE INDEX idx_essence_group_type ON essence_data (group_id, message_type)"
+    )
+
+
+async def create_search_triggers(conn):
+    # 触发器只用内置函数, 其它程序直接写表也能触发; 压缩成 BLOB 的文字精华由插件写入时补进索引
+    await conn.execute(
+        """CREATE TRIGGER essence_fts_ai AFTER INSERT ON essence_data
+           WHEN new.message_type = 'text' AND typeof(new.message_data) = 'text' BEGIN
+               INSERT INTO essence_fts (rowid, text) VALUES (new.id, new.message_data);
+           END"""
+    )
+    await conn.execute(
+        """CREATE TRIGGER essence_fts_ad AFTER DELETE ON essence_data BEGIN
+               DELETE FROM essence_fts WHERE rowid = old.id;
+           END"""
+    )
+    # 压缩只改变存储方式(新值是 BLOB), 内容不变, 不必重建索引
+    await conn.execute(
+        """CREATE TRIGGER essence_fts_au
+           AFTER UPDATE OF message_type, message_data ON essence_data
+           WHEN old.message_type IS NOT new.message_type
+           OR (typeof(new.message_data) = 'text' AND old.message_data IS NOT new.message_data) BEGIN
+               DELETE FROM essence_fts WHERE rowid = old.id;
+               INSERT INTO essence_fts (rowid, text)
+               SELECT new.id, new.message_data
+               WHERE new.message_type = 'text' AND typeof(new.message_data) = 'text';
+           END"""
+    )
+
+
+async def ensure_search_index(conn):
+    async with conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'essence_fts'"
+    ) as cursor:
+        if await cursor.fetchone():
+            return True
+    try:
+        # trigram 分词对中文按字切分, 不依赖额外的分词扩展
+        await conn.execute(
+            """CREATE VIRTUAL TABLE essence_fts
+               USING fts5(text, tokenize = 'trigram')"""
+        )
+    except aiosqlite.OperationalError:
+        # SQLite 未编译 FTS5 或版本低于 3.34, search 退回 LIKE
+        return False
+    await create_search_triggers(conn)
+    await conn.execute(
+        """INSERT INTO essence_fts (rowid, text)
+           SELECT id, essence_text(message_data) FROM essence_data WHERE message_type = 'text'"""
+    )
+    return True
+
+
+async def _v5_search_index(db, conn):
+    await ensure_search_index(conn)
+
+
+RANK_UP = """
+    INSERT INTO essence_rank_total (group_id, role, user_id, count)
+    VALUES ({row}.group_id, 'sender', {row}.sender_id, 1),
+           ({row}.group_id, 'operator', {row}.operator_id, 1)
+    ON CONFLICT (group_id, role, user_id) DO UPDATE SET count = count + 1;
+    INSERT INTO essence_rank_daily (group_id, role, day, user_id, count)
+    VALUES ({row}.group_id, 'sender', date({row}.time, 'unixepoch', 'localtime'), {row}.sender_id, 1),
+           ({row}.group_id, 'operator', date({row}.time, 'unixepoch', 'localtime'), {row}.operator_id, 1)
+    ON CONFLICT (group_id, role, day, user_id) DO UPDATE SET count = count + 1;
+"""
+
+RANK_DOWN = """
+    UPDATE essence_rank_total SET count = count - 1
+    WHERE group_id = {row}.group_id AND (
+        (role = 'sender' AND user_id = {row}.sender_id)
+        OR (role = 'operator' AND user_id = {row}.operator_id)
+    );
+    UPDATE essence_rank_daily SET count = count - 1
+    WHERE group_id = {row}.group_id
+    AND day = date({row}.time, 'unixepoch', 'localtime') AND (
+        (role = 'sender' AND user_id = {row}.sender_id)
+        OR (role = 'operator' AND user_id = {row}.operator_id)
+    );
+    DELETE FROM essence_rank_total WHERE group_id = {row}.group_id AND count <= 0;
+    DELETE FROM essence_rank_daily
+    WHERE group_id = {row}.group_id
+    AND day = date({row}.time, 'unixepoch', 'localtime') AND count <= 0;
+"""
+
+
+async def fill_rank_counters(conn, group_id=None):
+    where = "" if group_id is None else "WHERE group_id = ?"
+    params = () if group_id is None else (group_id, group_id)
+    await conn.execute(
+        f"""INSERT INTO essence_rank_total (group_id, role, user_id, count)
+            SELECT group_id, 'sender', sender_id, COUNT(*) FROM essence_data {where}
+            GROUP BY group_id, sender_id
+            UNION ALL
+            SELECT group_id, 'operator', operator_id, COUNT(*) FROM essence_data {where}
+            GROUP BY group_id, operator_id""",
+        params,
+    )
+    await conn.execute(
+        f"""INSERT INTO essence_rank_daily (group_id, role, day, user_id, count)
+            SELECT group_id, 'sender', date(time, 'unixepoch', 'localtime') AS day,
+                   sender_id, COUNT(*)
+            FROM essence_data {where} GROUP BY group_id, day, sender_id
+            UNION ALL
+            SELECT group_id, 'operator', date(time, 'unixepoch', 'localtime') AS day,
+                   operator_id, COUNT(*)
+            FROM essence_data {where} GROUP BY group_id, day, operator_id""",
+        params,
+    )
+
+
+async def _v6_rank_counters(db, conn):
+    # 排行榜计数随 essence_data 的触发器在同一事务内更新
+    await conn.execute(
+        """CREATE TABLE essence_rank_total (
+            group_id INTEGER,
+            role TEXT,
+            user_id INTEGER,
+            count INTEGER,
+            PRIMARY KEY (group_id, role, user_id)
+        ) WITHOUT ROWID"""
+    )
+    await conn.execute(
+        """CREATE INDEX idx_rank_total_count
+           ON essence_rank_total (group_id, role, count DESC)"""
+    )
+    await conn.execute(
+        """CREATE TABLE essence_rank_daily (
+            group_id INTEGER,
+            role TEXT,
+            day TEXT,
+            user_id INTEGER,
+            count INTEGER,
+            PRIMARY KEY (group_id, role, day, user_id)
+        ) WITHOUT ROWID"""
+    )
+    await conn.execute(
+        f"""CREATE TRIGGER essence_rank_ai AFTER INSERT ON essence_data BEGIN
+            {RANK_UP.format(row="new")}
+        END"""
+    )
+    await conn.execute(
+        f"""CREATE TRIGGER essence_rank_ad AFTER DELETE ON essence_data BEGIN
+            {RANK_DOWN.format(row="old")}
+        END"""
+    )
+    await conn.execute(
+        f"""CREATE TRIGGER essence_rank_au
+            AFTER UPDATE OF time, group_id, sender_id, operator_id ON essence_data BEGIN
+            {RANK_DOWN.format(row="old")}
+            {RANK_UP.format(row="new")}
+        END"""
+    )
+    await fill_rank_counters(conn)
+
+
+async def _v7_good_count(db, conn):
+    await conn.execute(
+        """CREATE TABLE good_count (
+            key TEXT PRIMARY KEY,
+            count INTEGER,
+            time INTEGER
+        ) WITHOUT ROWID"""
+    )
+    await conn.execute("CREATE INDEX idx_good_count_time ON good_count (time)")
+
+
+async def _v8_compact_user_mapping(db, conn):
+    # 每个 (group_id, user_id) 只保留最新的一条昵称
+    await conn.execute(
+        """DELETE FROM user_mapping WHERE EXISTS (
+               SELECT 1 FROM user_mapping AS newer
+               WHERE newer.group_id = user_mapping.group_id
+               AND newer.user_id = user_mapping.user_id
+               AND (newer.time > user_mapping.time
+                    OR (newer.time = user_mapping.time AND newer.rowid > user_mapping.rowid))
+           )"""
+    )
+    await conn.execute("DROP INDEX idx_user_mapping_latest")
+    await conn.execute(
+        "CREATE UNIQUE INDEX idx_user_mapping_user ON user_mapping (group_id, user_id)"
+    )
+
+
+async def _v9_message_keys(db, conn):
+    # message_id 和内容哈希作为精确的去重/撤销键, essence_hash 由连接注册
+    for table in ("essence_data", "del_essence_data"):
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN message_id INTEGER")
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN content_hash TEXT")
+        await conn.execute(
+            f"UPDATE {table} SET content_hash = essence_hash(sender_id, message_type, message_data)"
+        )
+    # 内容哈希只用来匹配没有 message_id 的旧数据, 不同时间设的同一内容是不同的精华
+    await conn.execute(
+        """CREATE INDEX idx_essence_content
+           ON essence_data (group_id, content_hash, time)"""
+    )
+    # 旧版本只在 ±1000 秒内按(发送者, 设精者, 内容)去重, 只合并这个窗口内留下的重复行
+    await conn.execute(
+        """DELETE FROM essence_data WHERE EXISTS (
+               SELECT 1 FROM essence_data AS older
+               WHERE older.group_id = essence_data.group_id
+               AND older.content_hash = essence_data.content_hash
+               AND older.time BETWEEN essence_data.time - 1000 AND essence_data.time + 1000
+               AND older.operator_id = essence_data.operator_id
+               AND older.id < essence_data.id
+           )"""
+    )
+    await conn.execute(
+        """CREATE UNIQUE INDEX idx_essence_message
+           ON essence_data (group_id, message_id) WHERE message_id IS NOT NULL"""
+    )
+    await conn.execute(
+        """CREATE INDEX idx_del_essence_content
+           ON del_essence_data (group_id, content_hash)"""
+    )
+
+
+DAILY_UP = """
+    INSERT INTO essence_daily (group_id, day, message_type, count)
+    VALUES ({row}.group_id, date({row}.time, 'unixepoch', 'localtime'), {row}.message_type, 1)
+    ON CONFLICT (group_id, day, message_type) DO UPDATE SET count = count + 1;
+"""
+
+DAILY_DOWN = """
+    UPDATE essence_daily SET count = count - 1
+    WHERE group_id = {row}.group_id
+    AND day = date({row}.time, 'unixepoch', 'localtime')
+    AND message_type = {row}.message_type;
+    DELETE FROM essence_daily
+    WHERE group_id = {row}.group_id
+    AND day = date({row}.time, 'unixepoch', 'localtime')
+    AND message_type = {row}.message_type AND count <= 0;
+"""
+
+
+async def _v10_daily_rollup(db, conn):
+    # 每群每天每种类型一行条数, 供 digest 直接汇总
+    await conn.execute(
+        """CREATE TABLE essence_daily (
+            group_id INTEGER,
+            day TEXT,
+            message_type TEXT,
+            count INTEGER,
+            PRIMARY KEY (group_id, day, message_type)
+        ) WITHOUT ROWID"""
+    )
+    await conn.execute(
+        f"""CREATE TRIGGER essence_daily_ai AFTER INSERT ON essence_data BEGIN
+            {DAILY_UP.format(row="new")}
+        END"""
+    )
+    await conn.execute(
+        f"""CREATE TRIGGER essence_daily_ad AFTER DELETE ON essence_data BEGIN
+            {DAILY_DOWN.format(row="old")}
+        END"""
+    )
+    await conn.execute(
+        f"""CREATE TRIGGER essence_daily_au
+            AFTER UPDATE OF time, group_id, message_type ON essence_data BEGIN
+            {DAILY_DOWN.format(row="old")}
+            {DAILY_UP.format(row="new")}
+        END"""
+    )
+    await conn.execute(
+        """INSERT INTO essence_daily (group_id, day, message_type, count)
+           SELECT group_id, date(time, 'unixepoch', 'localtime') AS day, message_type, COUNT(*)
+           FROM essence_data GROUP BY group_id, day, message_type"""
+    )
+
+
+async def _v11_compression(db, conn):
+    # 压缩字典按内容哈希编号, 旧字典压缩过的行仍要用它解码, 不删除
+    await conn.execute(
+        """CREATE TABLE compress_dict (
+            id INTEGER PRIMARY KEY,
+            data BLOB,
+            time INTEGER
+        )"""
+    )
+
+
+SEGMENT_SINGLE = """
+    INSERT INTO essence_segment (essence_id, ordinal, group_id, sender_id, type, data)
+    SELECT {row}.id, 0, {row}.group_id, {row}.sender_id, {row}.message_type, NULL
+    WHERE {row}.message_type IS NOT 'group';
+"""
+
+SEGMENT_INSERT = """INSERT OR IGNORE INTO essence_segment
+    (essence_id, ordinal, group_id, sender_id, type, data) VALUES (?, ?, ?, ?, ?, ?)"""
+
+
+async def fill_group_segments(conn, where="1", params=()):
+    # 多段消息要解析 message_data, 不放在触发器里, 由插件写入时补上
+    last = 0
+    while True:
+        async with conn.execute(
+            f"""SELECT id, group_id, sender_id, essence_text(message_data) FROM essence_data
+                WHERE {where} AND id > ? AND message_type = 'group'
+                AND NOT EXISTS (SELECT 1 FROM essence_segment WHERE essence_id = essence_data.id)
+                ORDER BY id LIMIT 500""",
+            (*params, last),
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        await conn.executemany(
+            SEGMENT_INSERT, [seg for row in rows for seg in segment_rows(*row)]
+        )
+        last = rows[-1][0]
+
+
+async def _v12_segments(db, conn):
+    # 每段一行, 按类型/发送者筛选精华时走索引, 不再解析 message_data;
+    # 触发器只用内置函数, 其它程序直接写表时单段消息照常维护
+    await conn.execute(
+        """CREATE TABLE essence_segment (
+            essence_id INTEGER,
+            ordinal INTEGER,
+            group_id INTEGER,
+            sender_id INTEGER,
+            type TEXT,
+            data TEXT,
+            PRIMARY KEY (essence_id, ordinal)
+        ) WITHOUT ROWID"""
+    )
+    await conn.execute(
+        """CREATE INDEX idx_segment_group_type
+           ON essence_segment (group_id, type)"""
+    )
+    await conn.execute(
+        """CREATE INDEX idx_segment_group_sender
+           ON essence_segment (group_id, sender_id, type)"""
+    )
+    await conn.execute(
+        f"""CREATE TRIGGER essence_segment_ai AFTER INSERT ON essence_data BEGIN
+            {SEGMENT_SINGLE.format(row="new")}
+        END"""
+    )
+    await conn.execute(
+        """CREATE TRIGGER essence_segment_ad AFTER DELETE ON essence_data BEGIN
+               DELETE FROM essence_segment WHERE essence_id = old.id;
+           END"""
+    )
+    await conn.execute(
+        """CREATE TRIGGER essence_segment_au
+            AFTER UPDATE OF group_id, sender_id, message_type ON essence_data
+            WHEN old.group_id IS NOT new.group_id OR old.sender_id IS NOT new.sender_id
+            OR old.message_type IS NOT new.message_type BEGIN
+            UPDATE essence_segment SET group_id = new.group_id, sender_id = new.sender_id
+            WHERE essence_id = old.id;
+            DELETE FROM essence_segment
+            WHERE essence_id = old.id AND old.message_type IS NOT new.message_type;
+            INSERT INTO essence_segment (essence_id, ordinal, group_id, sender_id, type, data)
+            SELECT new.id, 0, new.group_id, new.sender_id, new.message_type, NULL
+            WHERE new.message_type IS NOT 'group' AND old.message_type IS NOT new.message_type;
+        END"""
+    )
+    await conn.execute(
+        """INSERT INTO essence_segment (essence_id, ordinal, group_id, sender_id, type, data)
+           SELECT id, 0, group_id, sender_id, message_type, NULL FROM essence_data
+           WHERE message_type IS NOT 'group'"""
+    )
+    await fill_group_segments(conn)
+
+
+async def _v13_jobs(db, conn):
+    # 批量管理操作的任务和每一项的进度, 重启后从未完成的项继续
+    await conn.execute(
+        """CREATE TABLE job (
+            id INTEGER PRIMARY KEY,
+            kind TEXT,
+            group_id INTEGER,
+            self_id TEXT,
+            status TEXT,
+            total INTEGER,
+            done INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created INTEGER,
+            updated INTEGER
+        )"""
+    )
+    await conn.execute("CREATE INDEX idx_job_status ON job (status, self_id)")
+    await conn.execute("CREATE INDEX idx_job_group ON job (group_id, id)")
+    await conn.execute(
+        """CREATE TABLE job_item (
+            job_id INTEGER,
+            item_key TEXT,
+            payload TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (job_id, item_key)
+        ) WITHOUT ROWID"""
+    )
+
+
+# 按顺序追加, 不要修改已发布的迁移; 下标 + 1 即 PRAGMA user_version
+MIGRATIONS = [
+    _v1_base_tables,
+    _v2_primary_key_and_indexes,
+    _v3_images_to_store,
+    _v4_random_index,
+    _v5_search_index,
+    _v6_rank_counters,
+    _v7_good_count,
+    _v8_compact_user_mapping,
+    _v9_message_keys,
+    _v10_daily_rollup,
+    _v11_compression,
+    _v12_segments,
+    _v13_jobs,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def migrate(db, conn):
+    async with conn.execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"essence_message 数据库版本 {version} 高于插件支持的 {SCHEMA_VERSION}"
+        )
+    for target, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            await step(db, conn)
+            await conn.execute(f"PRAGMA user_version = {target}")
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+        await conn.execute("COMMIT")
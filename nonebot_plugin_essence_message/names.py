@@ -0,0 +1,95 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from nonebot import logger
+from nonebot.adapters.onebot.v11.bot import Bot
+
+
+def display_name(member) -> str:
+    return member["card"] or member["nickname"]
+
+
+class NicknameCache:
+    def __init__(self, db, maxsize: int = 4096, ttl: int = 3600):
+        self.db = db
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # (group_id, user_id) -> (昵称, 获取时间), 按最近使用排序
+        self._names = OrderedDict()
+        self._warmed = {}
+        self._warming = {}
+
+    def _remember(self, group_id, user_id, name, fetched):
+        key = (group_id, user_id)
+        self._names[key] = (name, fetched)
+        self._names.move_to_end(key)
+        while len(self._names) > self.maxsize:
+            self._names.popitem(last=False)
+
+    async def get(self, bot: Bot, group_id: int, user_id: int) -> str:
+        now = time.time()
+        cached = self._names.get((group_id, user_id))
+        if cached is None:
+            row = await self.db.get_latest_nickname(group_id, user_id)
+            if row is not None:
+                cached = row
+                self._remember(group_id, user_id, *row)
+        else:
+            self._names.move_to_end((group_id, user_id))
+        if cached is not None:
+            if now - cached[1] > self.ttl:
+                self.refresh(bot, group_id)
+            return cached[0]
+
+        await self.refresh(bot, group_id)
+        row = await self.db.get_latest_nickname(group_id, user_id)
+        if row is not None:
+            self._remember(group_id, user_id, *row)
+            return row[0]
+        # 已退群的成员不在成员列表里, 单独查一次
+        try:
+            member = await asyncio.wait_for(
+                bot.get_group_member_info(group_id=group_id, user_id=user_id), 3
+            )
+        except Exception:
+            return "<unknown>"
+        name = display_name(member)
+        await self.db.upsert_user_mappings([(name, group_id, user_id, int(now))])
+        self._remember(group_id, user_id, name, int(now))
+        return name
+
+    def refresh(self, bot: Bot, group_id: int) -> asyncio.Future:
+        # 同一个群同时只拉一次成员列表, ttl 内不重复拉
+        task = self._warming.get(group_id)
+        if task is None:
+            if time.time() - self._warmed.get(group_id, 0) <= self.ttl:
+                task = asyncio.get_running_loop().create_future()
+                task.set_result(None)
+                return task
+            task = asyncio.ensure_future(self._warm(bot, group_id))
+            self._warming[group_id] = task
+            task.add_done_callback(lambda _: self._warming.pop(group_id, None))
+        return task
+
+    async def _warm(self, bot: Bot, group_id: int):
+        now = int(time.time())
+        try:
+            members = await asyncio.wait_for(
+                bot.get_group_member_list(group_id=group_id, no_cache=True), 10
+            )
+        except Exception:
+            # 失败后一分钟内不再重试
+            self._warmed[group_id] = now - self.ttl + 60
+            return
+        self._warmed[group_id] = now
+        rows = [(display_name(m), group_id, m["user_id"], now) for m in members]
+        try:
+            await self.db.upsert_user_mappings(rows)
+        except Exception as e:
+            # 通常由 get() 在后台触发, 没有人等待结果, 在这里记录
+            logger.warning(f"保存群 {group_id} 的成员昵称失败: {e!r}")
+        # 只刷新已在缓存里的成员, 其余的留在数据库中按需读取
+        for name, _, user_id, _ in rows:
+            if (group_id, user_id) in self._names:
+                self._names[(group_id, user_id)] = (name, now)
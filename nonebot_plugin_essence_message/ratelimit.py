@@ -0,0 +1,64 @@
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class RateLimiter:
+    def __init__(self, capacity: int, period: float, max_keys: int = 100000):
+        # 令牌桶: 每个 key 最多攒 capacity 次, 每 period 秒补满
+        self.capacity = capacity
+        self.period = max(1, period)
+        self.rate = capacity / self.period
+        self.max_keys = max(1, max_keys)
+        # key -> [剩余次数, 上次更新的 monotonic 时间], 按最近使用排序
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def remaining(self, key, now: float = None) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        now = time.monotonic() if now is None else now
+        return min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def hit(self, key, now: float = None) -> bool:
+        # 还有次数时扣掉一次并返回 True
+        now = time.monotonic() if now is None else now
+        tokens = self.remaining(key, now)
+        if tokens < 1:
+            return False
+        self._buckets[key] = [tokens - 1, now]
+        self._buckets.move_to_end(key)
+        self._prune(now)
+        return True
+
+    def _prune(self, now: float):
+        # 已经补满的桶和不存在等价, 从最久未用的一端清掉; 仍超出上限时直接淘汰
+        buckets = self._buckets
+        while buckets:
+            key, (tokens, updated) = next(iter(buckets.items()))
+            if len(buckets) <= self.max_keys and tokens + (now - updated) * self.rate < self.capacity:
+                break
+            buckets.popitem(last=False)
+
+    def save(self, path: Path):
+        now, wall = time.monotonic(), time.time()
+        state = [
+            [key, tokens, wall - (now - updated)]
+            for key, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.rate < self.capacity
+        ]
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(json.dumps(state), encoding="utf-8")
+        tmp.replace(path)
+
+    def load(self, path: Path):
+        if not path.exists():
+            return
+        now, wall = time.monotonic(), time.time()
+        for key, tokens, updated in json.loads(path.read_text(encoding="utf-8")):
+            self._buckets[key] = [tokens, now - max(0, wall - updated)]
+        self._prune(now)
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from nonebot import logger
+
+
+class ReactionCounter:
+    def __init__(self, db, ttl: int, flush_delay: float = 5):
+        self.db = db
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        # key -> [count, 最后一次变动的时间]
+        self._counts = {}
+        self._dirty = set()
+        self._flush_task = None
+
+    async def load(self, legacy_file: Path = None):
+        now = int(time.time())
+        for key, count, updated in await self.db.load_good_counts(now - self.ttl):
+            self._counts[key] = [count, updated]
+        # 旧版 good_cache.json 只导入一次, 之后改名保留
+        if legacy_file is not None and legacy_file.exists():
+            legacy = json.loads(legacy_file.read_text(encoding="utf-8"))
+            for key, count in legacy.items():
+                if count > 0 and key not in self._counts:
+                    self._counts[key] = [count, now]
+                    self._dirty.add(key)
+            await self.flush()
+            legacy_file.replace(legacy_file.with_suffix(".json.bak"))
+
+    def get(self, key: str) -> int:
+        entry = self._counts.get(key)
+        if entry is None or entry[1] < time.time() - self.ttl:
+            return 0
+        return entry[0]
+
+    def _set(self, key: str, count: int) -> int:
+        self._counts[key] = [count, int(time.time())]
+        self._dirty.add(key)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+        return count
+
+    def add(self, key: str) -> int:
+        return self._set(key, self.get(key) + 1)
+
+    def remove(self, key: str) -> int:
+        return self._set(key, max(self.get(key) - 1, 0))
+
+    async def _delayed_flush(self):
+        try:
+            await asyncio.sleep(self.flush_delay)
+        finally:
+            self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # 未写入的计数仍标记为 dirty, 下次变动或关闭时再写
+            logger.warning(f"保存点赞计数失败: {e!r}")
+
+    async def flush(self):
+        expire_before = int(time.time()) - self.ttl
+        dirty, self._dirty = self._dirty, set()
+        rows = [(key, *self._counts[key]) for key in dirty if key in self._counts]
+        for key in [k for k, (_, t) in self._counts.items() if t < expire_before]:
+            del self._counts[key]
+        try:
+            await self.db.save_good_counts(rows, expire_before)
+        except BaseException:
+            self._dirty |= dirty
+            raise
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
@@ -0,0 +1,34 @@
+import json
+import re
+
+# formatter 把多段消息存为 [["type", "data"], ...] 的 JSON;
+# 旧版本拼成 "[type,data],[type,data],", 只能按 "]," 后紧跟下一段开头或结尾来切分,
+# 内容本身含有 "],[x," 时无法区分, 这类旧数据尽力解析
+SEGMENT_PATTERN = re.compile(r"\[(\w+),(.*?)\],(?=\[\w+,|$)", re.S)
+
+
+def parse_segments(message_type, message_data):
+    # 返回 [(类型, 内容), ...]; 单段消息的内容就是 message_data 本身
+    if message_type != "group":
+        return [(message_type, message_data)]
+    if (message_data or "").startswith("[["):
+        try:
+            return [(kind, data) for kind, data in json.loads(message_data)]
+        except (TypeError, ValueError):
+            pass
+    return SEGMENT_PATTERN.findall(message_data or "")
+
+
+def canonical_text(message_type, message_data) -> str:
+    # 新旧两种 group 格式的同一内容得到同一文本, 用于去重
+    if message_type != "group":
+        return str(message_data)
+    return "".join(f"[{kind},{data}]," for kind, data in parse_segments(message_type, message_data))
+
+
+def segment_rows(essence_id, group_id, sender_id, message_data):
+    # 多段消息在 essence_segment 中的行; 单段消息由触发器写入, 内容不重复保存
+    return [
+        (essence_id, ordinal, group_id, sender_id, kind, data)
+        for ordinal, (kind, data) in enumerate(parse_segments("group", message_data))
+    ]
@@ -0,0 +1,248 @@
+import asyncio
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from nonebot import logger
+
+from .dateset import DatabaseHandler
+
+
+def _routed(name, index=0, key=None):
+    # 按第 index 个参数(或其中的第 key 项)确定群号, 转发给该群的分库
+    async def method(self, *args, **kwargs):
+        group_id = args[index] if key is None else args[index][key]
+        async with self._shard(group_id) as db:
+            return await getattr(db, name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+def _on_main(name):
+    # 不属于某个群的数据(点赞计数、批量任务)保存在主库
+    async def method(self, *args, **kwargs):
+        return await getattr(self.main, name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+def shard_groups(shard_dir):
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(
+        int(name[:-3])
+        for name in os.listdir(shard_dir)
+        if name.endswith(".db") and name[:-3].lstrip("-").isdigit()
+    )
+
+
+async def merge_shards(main, shard_dir):
+    # 关闭分库后把各群的分库并回主库, 每个群并入后才删除分库文件, 中断后可重跑
+    groups = shard_groups(str(shard_dir))
+    for group_id in groups:
+        path = os.path.join(str(shard_dir), f"{group_id}.db")
+        await main.import_group(path, group_id)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    if groups:
+        logger.info(f"已将 {shard_dir} 中 {len(groups)} 个群的精华并回主库")
+    return len(groups)
+
+
+class ShardedDatabase:
+    def __init__(
+        self,
+        db_path,
+        shard_dir,
+        max_open: int = 32,
+        read_pool_size: int = 4,
+        shard_pool_size: int = 1,
+        img_store=None,
+        batch_size: int = 200,
+        batch_delay: float = 0.5,
+        compress: bool = False,
+        compress_min_bytes: int = 64,
+    ):
+        # 主库保存不属于某个群的数据, 每个群的精华在 shard_dir/<群号>.db
+        self.main = DatabaseHandler(
+            db_path,
+            read_pool_size,
+            img_store,
+            batch_size,
+            batch_delay,
+            compress,
+            compress_min_bytes,
+        )
+        self.db_path = self.main.db_path
+        self.img_store = self.main.img_store
+        self.shard_dir = str(shard_dir)
+        self.max_open = max(1, max_open)
+        # 每个分库一个写连接加 shard_pool_size 个只读连接, 打开的分库多时线程和连接数成倍增长
+        self.shard_pool_size = shard_pool_size
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        # group_id -> DatabaseHandler, 按最近使用排序; _users 记录正在使用的次数
+        self._shards = OrderedDict()
+        self._users = {}
+        self._closing = {}
+        self._opening = None
+
+    def shard_path(self, group_id) -> str:
+        return os.path.join(self.shard_dir, f"{int(group_id)}.db")
+
+    def shard_groups(self):
+        return shard_groups(self.shard_dir)
+
+    async def open(self):
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._open())
+        try:
+            await asyncio.shield(self._opening)
+        except BaseException:
+            if self._opening is not None and self._opening.done():
+                self._opening = None
+            raise
+
+    async def _open(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        await self.main.open()
+        await self.split()
+
+    async def split(self):
+        # 把主库里按群的数据拆到各自的分库, 每个群拷贝完成后才从主库删除, 中断后可重跑
+        groups = await self.main.group_ids()
+        for group_id in groups:
+            async with self._shard(group_id) as db:
+                await db.import_group(self.main.db_path, group_id)
+            await self.main.drop_group(group_id)
+        if groups:
+            logger.info(f"已将 {len(groups)} 个群的精华拆分到 {self.shard_dir}")
+        return len(groups)
+
+    async def close(self):
+        shards, self._shards = list(self._shards.values()), OrderedDict()
+        await asyncio.gather(*(db.close() for db in shards))
+        await asyncio.gather(*list(self._closing.values()))
+        await self.main.close()
+        self._opening = None
+
+    async def flush_pending(self):
+        await asyncio.gather(*(db.flush_pending() for db in list(self._shards.values())))
+
+    @asynccontextmanager
+    async def _shard(self, group_id):
+        group_id = int(group_id)
+        closing = self._closing.get(group_id)
+        if closing is not None:
+            await asyncio.shield(closing)
+        db = self._shards.get(group_id)
+        if db is None:
+            db = DatabaseHandler(
+                self.shard_path(group_id),
+                self.shard_pool_size,
+                self.img_store,
+                self.batch_size,
+                self.batch_delay,
+                self.compress,
+                self.compress_min_bytes,
+            )
+            self._shards[group_id] = db
+        self._shards.move_to_end(group_id)
+        self._users[group_id] = self._users.get(group_id, 0) + 1
+        try:
+            self._evict()
+            await db.open()
+            yield db
+        finally:
+            self._users[group_id] -= 1
+            if not self._users[group_id]:
+                del self._users[group_id]
+            self._evict()
+
+    def _evict(self):
+        # 超出上限时关闭最久未用且空闲的分库, 正在使用的分库暂时保留
+        for group_id in list(self._shards):
+            if len(self._shards) <= self.max_open:
+                return
+            if group_id in self._users:
+                continue
+            db = self._shards.pop(group_id)
+            task = asyncio.ensure_future(db.close())
+            self._closing[group_id] = task
+            task.add_done_callback(lambda _, g=group_id: self._closing.pop(g, None))
+
+    async def fetch_all(self):
+        rows = []
+        for group_id in self.shard_groups():
+            async with self._shard(group_id) as db:
+                rows.extend(await db.fetch_all())
+        return rows
+
+    async def vacuum(self, batch_size: int = 500, keep_seconds: int = 86400):
+        total = await self.main.vacuum(batch_size, keep_seconds)
+        for group_id in self.shard_groups():
+            async with self._shard(group_id) as db:
+                result = await db.vacuum(batch_size, keep_seconds)
+            for key, value in result.items():
+                total[key] += value
+        return total
+
+    async def group_ids(self):
+        return self.shard_groups()
+
+    async def insert_many(self, datas):
+        groups = {}
+        for data in datas:
+            groups.setdefault(data[1], []).append(data)
+        inserted = 0
+        for group_id, rows in groups.items():
+            async with self._shard(group_id) as db:
+                inserted += await db.insert_many(rows)
+        return inserted
+
+    async def upsert_user_mappings(self, rows):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[1], []).append(row)
+        for group_id, group_rows in groups.items():
+            async with self._shard(group_id) as db:
+                await db.upsert_user_mappings(group_rows)
+
+    async def iter_group_data(self, group_id, chunk_size=500):
+        async with self._shard(group_id) as db:
+            async for rows in db.iter_group_data(group_id, chunk_size):
+                yield rows
+
+    load_good_counts = _on_main("load_good_counts")
+    save_good_counts = _on_main("save_good_counts")
+    create_job = _on_main("create_job")
+    running_jobs = _on_main("running_jobs")
+    pending_job_items = _on_main("pending_job_items")
+    update_job_items = _on_main("update_job_items")
+    finish_job = _on_main("finish_job")
+    recent_jobs = _on_main("recent_jobs")
+    insert_data = _routed("insert_data", key=1)
+    insert_del_data = _routed("insert_del_data", key=1)
+    queue_insert = _routed("queue_insert", key=1)
+    queue_del_data = _routed("queue_del_data", key=1)
+    delete_entry = _routed("delete_entry", key=1)
+    check_entry_exists = _routed("check_entry_exists", key=1)
+    insert_user_mapping = _routed("insert_user_mapping", 1)
+    summary_by_date = _routed("summary_by_date", 1)
+    digest = _routed("digest")
+    random_essence = _routed("random_essence")
+    sender_segments = _routed("sender_segments")
+    sender_rank = _routed("sender_rank")
+    operator_rank = _routed("operator_rank")
+    rebuild_rank = _routed("rebuild_rank")
+    delete_data_by_group = _routed("delete_data_by_group")
+    drop_group = _routed("drop_group")
+    search_entries = _routed("search_entries")
+    export_group_data = _routed("export_group_data")
+    get_latest_nickname = _routed("get_latest_nickname")
+    delete_matching_entry = _routed("delete_matching_entry")
@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+import nonebot
+import pytest
+from nonebot.adapters.onebot.v11 import Adapter
+from nonebug import NONEBOT_INIT_KWARGS
+
+
+def pytest_configure(config: pytest.Config):
+    # 插件加载时就会打开数据库, 数据目录要在加载前指向临时目录
+    root = tempfile.mkdtemp(prefix="essence-test-")
+    for kind in ("data", "cache", "config"):
+        os.environ[f"LOCALSTORE_{kind.upper()}_DIR"] = os.path.join(root, kind)
+    config.stash[NONEBOT_INIT_KWARGS] = {
+        "driver": "~none",
+        "superusers": {"10"},
+        "command_start": {""},
+    }
+
+
+@pytest.fixture(scope="session", autouse=True)
+def load_plugin(nonebug_init: None):
+    nonebot.get_driver().register_adapter(Adapter)
+    nonebot.load_plugin("nonebot_plugin_essence_message")
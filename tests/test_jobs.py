@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    requests = Counter()
+    delay = 0.05
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        time.sleep(self.delay)
+        if self.path.startswith("/missing"):
+            self.send_error(404)
+            return
+        body = f"image {self.path}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    ImageHandler.requests.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+class FakeBot:
+    self_id = "99"
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_group_msg(self, group_id, message):
+        self.sent.append((group_id, message))
+
+
+def essence(message_id, url):
+    return {
+        "message_id": message_id,
+        "sender_nick": "alice",
+        "operator_time": 1700000000 + message_id,
+        "content": [{"type": "image", "data": {"url": url}}],
+    }
+
+
+def save_runner(db):
+    from nonebot_plugin_essence_message.Helper import save_images, save_manifest
+    from nonebot_plugin_essence_message.jobs import JobRunner
+
+    runner = JobRunner(db, concurrency=1, retries=1, backoff=0.01, checkpoint_every=1)
+    runner.register("saveall", "保存精华图片", save_images, save_manifest)
+    return runner
+
+
+async def wait_until(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not await predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.02)
+
+
+async def test_saveall_resumes_from_checkpoint(tmp_path, image_server):
+    from nonebot_plugin_essence_message.dateset import DatabaseHandler
+    from nonebot_plugin_essence_message.imgstore import ImageStore
+
+    db = DatabaseHandler(str(tmp_path / "essence.db"), img_store=ImageStore(tmp_path / "img"))
+    await db.open()
+    bot = FakeBot()
+    group_id = 501
+    items = [(i, essence(i, f"{image_server}/{i}.png")) for i in range(10)]
+    items.append((10, essence(10, f"{image_server}/missing.png")))
+    try:
+        runner = save_runner(db)
+        job_id = await runner.start(bot, "saveall", group_id, items)
+
+        async def some_done():
+            jobs = await db.running_jobs(bot.self_id)
+            return jobs and jobs[0][5] >= 3
+
+        await wait_until(some_done)
+        # 模拟关机: 已完成的项写入检查点, 任务保持 running
+        await runner.close()
+        [(resumed_id, kind, _, _, total, processed)] = await db.running_jobs(bot.self_id)
+        assert (resumed_id, kind, total) == (job_id, "saveall", 11)
+        assert 3 <= processed < 11
+        assert len(await db.pending_job_items(job_id)) == total - processed
+
+        runner = save_runner(db)
+        await runner.resume(bot)
+        assert runner.running(group_id) == [job_id]
+
+        async def finished():
+            return not runner.running(group_id)
+
+        await wait_until(finished)
+        assert await db.running_jobs(bot.self_id) == []
+        assert "成功 10/11" in bot.sent[-1][1] and "失败 1" in bot.sent[-1][1]
+        # 检查点之前完成的图片不会重新下载, 只有关机时正在下载的一张可能重复
+        downloads = sum(n for path, n in ImageHandler.requests.items() if path != "/missing.png")
+        assert set(ImageHandler.requests) >= {f"/{i}.png" for i in range(10)}
+        assert downloads <= 11
+        assert ImageHandler.requests["/missing.png"] == 2
+    finally:
+        await db.close()
+
+
+async def test_saveall_skips_finished_essences(tmp_path, image_server):
+    from nonebot_plugin_essence_message.Helper import _image_manifest, save_images
+    from nonebot_plugin_essence_message.config import config
+
+    ImageHandler.delay = 0
+    try:
+        url = f"{image_server}/shared.png"
+        # 两条精华同时保存同一张图片, 只留一个文件
+        await asyncio.gather(
+            save_images(None, 502, essence(1, url)), save_images(None, 502, essence(2, url))
+        )
+        manifest = await _image_manifest()
+        [filename] = manifest["done"]["502_1"]
+        assert manifest["done"]["502_2"] == [filename]
+        assert not list(config.img().glob("*.part"))
+
+        await save_images(None, 502, essence(1, url))
+        assert ImageHandler.requests["/shared.png"] == 2
+        # 文件被删掉后重新下载
+        (config.img() / filename).unlink()
+        await save_images(None, 502, essence(1, url))
+        assert (config.img() / filename).exists()
+        assert ImageHandler.requests["/shared.png"] == 3
+    finally:
+        ImageHandler.delay = 0.05
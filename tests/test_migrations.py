@@ -0,0 +1,115 @@
+import base64
+import sqlite3
+
+LEGACY_SCHEMA = """
+CREATE TABLE essence_data (
+    time INTEGER, group_id INTEGER, sender_id INTEGER, operator_id INTEGER,
+    message_type TEXT, message_data TEXT
+);
+CREATE TABLE user_mapping (nickname TEXT, group_id INTEGER, user_id INTEGER, time INTEGER);
+CREATE TABLE del_essence_data (
+    time INTEGER, group_id INTEGER, sender_id INTEGER, operator_id INTEGER,
+    message_type TEXT, message_data TEXT
+);
+"""
+
+IMAGE = base64.b64encode(b"\x89PNG legacy image").decode()
+
+
+def legacy_db(path, rows):
+    # 0.2.x 版本建的库: 没有主键、索引和 user_version
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany("INSERT INTO essence_data VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.execute("INSERT INTO user_mapping VALUES ('alice', 1, 5, 100)")
+    conn.commit()
+    conn.close()
+
+
+async def open_db(tmp_path, rows):
+    from nonebot_plugin_essence_message.dateset import DatabaseHandler
+    from nonebot_plugin_essence_message.imgstore import ImageStore
+
+    path = tmp_path / "essence.db"
+    legacy_db(path, rows)
+    db = DatabaseHandler(str(path), img_store=ImageStore(tmp_path / "img"))
+    await db.open()
+    return db, path
+
+
+def column(path, sql, params=()):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+async def test_legacy_db_migrates_to_latest(tmp_path):
+    from nonebot_plugin_essence_message.migrations import MIGRATIONS
+
+    text = "教程: 图片写成 base64://" + IMAGE + " 就行"
+    db, path = await open_db(
+        tmp_path,
+        [
+            (1000, 1, 5, 6, "text", text),
+            (2000, 1, 5, 6, "image", "base64://" + IMAGE),
+            (3000, 1, 5, 6, "image", "base64://不是base64"),
+            (4000, 1, 5, 6, "group", f"[text,看图],[image,base64://{IMAGE}],"),
+        ],
+    )
+    try:
+        assert column(path, "PRAGMA user_version") == [len(MIGRATIONS)]
+        data = column(path, "SELECT message_data FROM essence_data ORDER BY time")
+        # 文字里的 base64:// 和解不开的内容保持原样
+        assert data[0] == text
+        assert data[2] == "base64://不是base64"
+        assert data[1].startswith("sha256://")
+        assert db.img_store.path(data[1]).read_bytes() == b"\x89PNG legacy image"
+        assert data[3] == f"[text,看图],[image,{data[1]}],"
+        assert column(
+            path, "SELECT type FROM essence_segment WHERE data IS NOT NULL ORDER BY ordinal"
+        ) == ["text", "image"]
+        rows = await db.search_entries(1, "base64")
+        assert [row[5] for row in rows] == [text]
+    finally:
+        await db.close()
+
+
+async def test_legacy_duplicates_only_merged_within_window(tmp_path):
+    db, path = await open_db(
+        tmp_path,
+        [
+            (1000, 1, 5, 6, "text", "早上好"),
+            (1500, 1, 5, 6, "text", "早上好"),
+            (90000, 1, 5, 6, "text", "早上好"),
+            (1000, 1, 5, 7, "text", "早上好"),
+        ],
+    )
+    try:
+        assert column(path, "SELECT time FROM essence_data ORDER BY time, operator_id") == [
+            1000,
+            1000,
+            90000,
+        ]
+        # 再次抓取到同一条精华时补上 message_id, 不另存一条
+        assert await db.insert_data([1200, 1, 5, 6, "text", "早上好", 42]) is None
+        assert column(
+            path, "SELECT message_id FROM essence_data WHERE time = 1000 AND operator_id = 6"
+        ) == [42]
+    finally:
+        await db.close()
+
+
+async def test_migration_is_idempotent(tmp_path):
+    from nonebot_plugin_essence_message.dateset import DatabaseHandler
+
+    db, path = await open_db(tmp_path, [(1000, 1, 5, 6, "text", "你好世界")])
+    await db.close()
+    db = DatabaseHandler(str(path), img_store=db.img_store)
+    await db.open()
+    try:
+        assert column(path, "SELECT COUNT(*) FROM essence_data") == [1]
+        assert [row[5] for row in await db.search_entries(1, "你好世界")] == ["你好世界"]
+    finally:
+        await db.close()
@@ -0,0 +1,72 @@
+import pytest
+
+
+def test_formatted_group_round_trip():
+    import json
+
+    from nonebot_plugin_essence_message.segments import parse_segments, segment_rows
+
+    # 内容里带 "],[" 的文本在旧格式中会被切出一个不存在的 bar 段
+    data = json.dumps([["text", "foo],[bar, baz"], ["at", "1"]], ensure_ascii=False)
+    assert parse_segments("group", data) == [("text", "foo],[bar, baz"), ("at", "1")]
+    assert segment_rows(7, 100, 200, data) == [
+        (7, 0, 100, 200, "text", "foo],[bar, baz"),
+        (7, 1, 100, 200, "at", "1"),
+    ]
+
+
+@pytest.mark.parametrize(
+    ("data", "expected"),
+    [
+        ("[text,a,b],[at,1],", [("text", "a,b"), ("at", "1")]),
+        ("[text,[x]],[image,img:ab],", [("text", "[x]"), ("image", "img:ab")]),
+        ("[text,多行\n文本],", [("text", "多行\n文本")]),
+        ("[text,],", [("text", "")]),
+        ("", []),
+        (None, []),
+    ],
+)
+def test_legacy_group_segments(data, expected):
+    from nonebot_plugin_essence_message.segments import parse_segments
+
+    assert parse_segments("group", data) == expected
+
+
+def test_single_segment():
+    from nonebot_plugin_essence_message.segments import parse_segments
+
+    assert parse_segments("text", "[text,a],") == [("text", "[text,a],")]
+
+
+def test_legacy_and_json_hash_equal():
+    import json
+
+    from nonebot_plugin_essence_message.dateset import content_hash
+
+    legacy = "[text,你好],[at,1],"
+    data = json.dumps([["text", "你好"], ["at", "1"]], ensure_ascii=False)
+    assert content_hash(1, "group", legacy) == content_hash(1, "group", data)
+    assert content_hash(1, "group", data) != content_hash(2, "group", data)
+
+
+async def test_formatter_emits_json():
+    from nonebot_plugin_essence_message.formatter import MessageFormatter
+    from nonebot_plugin_essence_message.segments import parse_segments
+
+    async def download(url):
+        return "img:" + url
+
+    msg = {
+        "message": [
+            {"type": "text", "data": {"text": "foo],[bar, baz"}},
+            {"type": "at", "data": {"qq": 1}},
+            {"type": "image", "data": {"url": "u"}},
+        ]
+    }
+    message_type, data = await MessageFormatter(download).format(msg, None)
+    assert message_type == "group"
+    assert parse_segments(message_type, data) == [
+        ("text", "foo],[bar, baz"),
+        ("at", "1"),
+        ("image", "img:u"),
+    ]
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+
+async def open_db(tmp_path, **kwargs):
+    from nonebot_plugin_essence_message.dateset import DatabaseHandler
+    from nonebot_plugin_essence_message.imgstore import ImageStore
+
+    db = DatabaseHandler(
+        str(tmp_path / "essence.db"), img_store=ImageStore(tmp_path / "img"), **kwargs
+    )
+    await db.open()
+    return db
+
+
+def failing_writes(db, bad="坏数据"):
+    # 含 bad 的批次写入时抛出异常, 其它批次照常写入
+    write_batch = db._write_batch
+
+    async def write(batch):
+        if any(row[5] == bad for _, row in batch):
+            raise RuntimeError("disk I/O error")
+        await write_batch(batch)
+
+    db._write_batch = write
+
+
+async def test_queued_rows_visible_to_reads(tmp_path):
+    db = await open_db(tmp_path, batch_size=100, batch_delay=60)
+    try:
+        for i in range(5):
+            await db.queue_insert([i, 1, 5, 6, "text", f"消息{i}", i + 1])
+        await db.queue_del_data([9, 1, 5, 6, "text", "撤销", 99])
+        assert len(await db.fetch_all()) == 5
+    finally:
+        await db.close()
+
+
+async def test_failed_batch_does_not_break_reads(tmp_path):
+    db = await open_db(tmp_path, batch_size=1, batch_delay=0.01, flush_retries=3)
+    failing_writes(db)
+    try:
+        await db.queue_insert([1, 1, 5, 6, "text", "坏数据", 1])
+        # 提交失败只记录日志, 读取照常进行
+        assert await db.fetch_all() == []
+        await db.queue_insert([2, 1, 5, 6, "text", "好数据", 2])
+        for _ in range(100):
+            if not db._pending and db._flushing is None:
+                break
+            await asyncio.sleep(0.02)
+        # 多次失败的批次转存到 failed_writes.jsonl, 后面的写入不受影响
+        assert [row[5] for row in await db.fetch_all()] == ["好数据"]
+        lines = (tmp_path / "failed_writes.jsonl").read_text(encoding="utf-8").splitlines()
+        assert [json.loads(line)["row"][5] for line in lines] == ["坏数据"]
+    finally:
+        await db.close()
+
+
+async def test_close_saves_unwritten_rows(tmp_path):
+    db = await open_db(tmp_path, batch_size=100, batch_delay=60)
+    failing_writes(db)
+    await db.queue_insert([1, 1, 5, 6, "text", "坏数据", 1])
+    await db.close()
+    assert db._writer is None and db._readers == []
+    lines = (tmp_path / "failed_writes.jsonl").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["table"] for line in lines] == ["essence_data"]